@@ -472,6 +472,7 @@ exports.createCaseFromFiles = [
 /**
  * Confirms and updates a draft case, marking it as finalized.
  * @param {Object} req - Express request object, containing case ID in `req.params.id` and update data in `req.body`.
+ *                       An optional `socketId` in `req.body` receives the embedding progress of the LLM backend.
  * @param {Object} res - Express response object to send the updated case or an error message.
  * @returns {Object} JSON response with the updated case or an error message.
  */
@@ -543,10 +544,12 @@ exports.confirmCase = [
         JSON.stringify(updatedCaseWithAttachments),
       );
 
-      // Send data to the LLM endpoint.
+      // Send data to the LLM endpoint, the socket id is used to report the embedding progress.
       const llmResponse = await axios.post(
         `${process.env.LLM_API_URL}/save_to_vector_db`,
-        updatedCaseWithAttachments,
+        req.body.socketId
+          ? { ...updatedCaseWithAttachments.toJSON(), socket_id: req.body.socketId }
+          : updatedCaseWithAttachments,
       );
 
       //const responseData = llmResponse.data;
@@ -213,6 +213,7 @@ router.post(
  * @param {string} [status] - Updated status.
  * @param {string} [case_type] - Updated case type.
  * @param {string} [priority] - Updated priority.
+ * @param {string} [socketId] - Socket ID that receives the embedding progress of the case.
  * @returns {Object} 200 - The confirmed (updated) case with attachments.
  * @returns {Error} 404 - Case not found.
  * @returns {Error} 500 - Internal server error.
@@ -229,6 +230,7 @@ router.put(
     "status",
     "case_type",
     "priority",
+    "socketId",
   ]),
   validateData(caseSchema),
   caseController.confirmCase,
@@ -8,6 +8,11 @@ module.exports = (io) => {
       io.to(socket_id).emit("llm_message", { message });
     });
 
+    // Receive a delta of the streamed chat answer from LLM
+    socket.on("llm_delta", ({ socket_id, message, offset }) => {
+      io.to(socket_id).emit("llm_delta", { message, offset });
+    });
+
     socket.on("front_identify", () => {
       console.log("Fronted connected with socket ID:", socket.id);
     });
@@ -1,4 +1,5 @@
 import os
+import threading
 import time
 
 import socketio
@@ -27,18 +28,49 @@
     os.makedirs(temp_folder)
 
 
-# init socket connection
-sio = socketio.Client(engineio_logger=False, logger=False, ssl_verify=False)
+SOCKET_URL = os.getenv("SOCKET_URL", "https://node_backend:3000")
 
-connected = False
-while not connected:
-    try:
-        sio.connect("https://node_backend:3000")
-        print("Socket established")
-        connected = True
-    except Exception as ex:
-        print("Failed to establish initial connnection to server:", type(ex).__name__)
-        time.sleep(2)
+
+class SocketClient(socketio.Client):
+    """
+    Socket client whose messages are dropped while there is no connection to the node backend,
+    so requests do not fail because progress messages can not be delivered.
+    """
+    def emit(self, event, data=None, namespace=None, callback=None):
+        if not self.connected:
+            print(f"Socket not connected, dropped {event}")
+            return
+        try:
+            super().emit(event, data=data, namespace=namespace, callback=callback)
+        except socketio.exceptions.SocketIOError as ex:
+            print(f"Failed to emit {event}:", type(ex).__name__)
+
+
+# init socket client, the connection is established in the background by start_socket
+sio = SocketClient(engineio_logger=False, logger=False, ssl_verify=False)
+_socket_thread = None
+
+
+def start_socket():
+    """
+    connect to the node backend in a background thread
+    the initial connection is retried until it succeeds, afterwards the client reconnects on its own
+    """
+    global _socket_thread
+    if _socket_thread is not None:
+        return
+
+    def connect_loop():
+        while not sio.connected:
+            try:
+                sio.connect(SOCKET_URL)
+                print("Socket established")
+            except Exception as ex:
+                print("Failed to establish initial connnection to server:", type(ex).__name__)
+                time.sleep(2)
+
+    _socket_thread = threading.Thread(target=connect_loop, name="socket-connect", daemon=True)
+    _socket_thread.start()
 
 @sio.event
 def connect():
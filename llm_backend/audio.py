@@ -1,7 +1,54 @@
-from pydub import AudioSegment
+import json
+import os
+import subprocess
 
+from flask import abort
 
-def split_audio_with_overlap(file_path, segment_length_ms=600000, overlap_ms=10000):
+
+def probe_media(file_path):
+    """
+    Read the duration and the audio codec of a media file from its metadata with ffprobe.
+    The file is not decoded.
+
+    Parameters:
+        file_path (str): The path to the media file.
+
+    Returns:
+        Tuple[float, str]: The duration in seconds and the codec name of the first audio stream (None if there is none).
+    """
+    command = [
+        "ffprobe",
+        "-v", "quiet",  # less logs
+        "-print_format", "json",  # machine readable output
+        "-show_format",  # container metadata including the duration
+        "-show_streams",  # stream metadata including the codecs
+        file_path
+    ]
+
+    try:
+        result = subprocess.run(command, check=True, capture_output=True, text=True)
+        metadata = json.loads(result.stdout)
+    except (subprocess.CalledProcessError, json.JSONDecodeError) as e:
+        abort(500, description=f"Error FFPROBE (Reading Metadata): {e}")
+
+    audio_codec = None
+    for stream in metadata.get("streams", []):
+        if stream.get("codec_type") == "audio":
+            audio_codec = stream.get("codec_name")
+            break
+
+    duration = metadata.get("format", {}).get("duration")
+    if duration is None:
+        # some containers (e.g. webm, mkv) only store the duration per stream
+        stream_durations = [float(stream["duration"]) for stream in metadata.get("streams", []) if "duration" in stream]
+        if not stream_durations:
+            abort(500, description=f"Error FFPROBE (Reading Metadata): no duration found in {file_path}")
+        duration = max(stream_durations)
+
+    return float(duration), audio_codec
+
+
+def split_audio_with_overlap(file_path, output_dir, segment_length_ms=600000, overlap_ms=10000):
     """
     Splits an audio file into multiple segments with overlap.
 
@@ -10,31 +57,53 @@ def split_audio_with_overlap(file_path, segment_length_ms=600000, overlap_ms=100
     overlap between consecutive segments to ensure that words cut off during
     splitting can still be recognized in the next segment.
 
+    The segments are cut by ffmpeg with input seeking, so the audio is never
+    decoded into memory. MP3 input is copied without re-encoding.
+
     Parameters:
         file_path (str): The path to the audio file to be split.
+        output_dir (str): The directory the segments are written to.
         segment_length_ms (int): The length of each segment in milliseconds.
                                  Default is 600,000 ms (10 minutes).
         overlap_ms (int): The overlap between consecutive segments in milliseconds.
                           Default is 10,000 ms (10 seconds).
 
     Returns:
-        List[AudioSegment]: A list of audio segments with overlap applied.
+        List[str]: A list of paths to the mp3 segments with overlap applied.
     """
-    # Load the audio file
-    audio = AudioSegment.from_file(file_path)
+    duration, audio_codec = probe_media(file_path)
+    duration_ms = duration * 1000
+    codec_args = ["-c:a", "copy"] if audio_codec == "mp3" else ["-b:a", "192k", "-acodec", "libmp3lame"]
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
 
     # Initialize variables
-    segments = []  # List to store the resulting audio segments
+    segments = []  # List to store the paths of the resulting audio segments
     start = 0  # Starting point for the current segment in milliseconds
 
     # Loop to create segments until the end of the audio file is reached
-    while start < len(audio):
-        # Calculate the endpoint for the current segment, including overlap
-        end = start + segment_length_ms
-        segment = audio[start:end + overlap_ms]  # Extract the segment with overlap
+    while start < duration_ms:
+        segment_path = os.path.join(output_dir, f"audio_{len(segments)}.mp3")
+        command = [
+            "ffmpeg",
+            "-v", "quiet",  # less logs
+            "-y",  # override file
+            "-ss", str(start / 1000),  # seek to the start of the segment without decoding
+            "-t", str((segment_length_ms + overlap_ms) / 1000),  # segment length including overlap
+            "-i", file_path,  # set input file
+            "-map", "0:a:0",  # only the audio stream
+            *codec_args,
+            segment_path  # define output
+        ]
+
+        try:
+            subprocess.run(command, check=True)
+        except subprocess.CalledProcessError as e:
+            abort(500, description=f"Error FFMPEG (Audio Splitting): {e}")
 
         # Append the segment to the list
-        segments.append(segment)
+        segments.append(segment_path)
 
         # Move the start point forward, accounting for the overlap
         start += segment_length_ms - overlap_ms
@@ -1,7 +1,15 @@
+import math
 import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 
 from langchain_openai import AzureChatOpenAI
-from openai import AzureOpenAI
+from openai import AzureOpenAI, RateLimitError
+
+from components import component
 
 
 # Getting all Env Variables
@@ -11,32 +19,49 @@
 AZURE_DEPLOYMENT_WHISPER = os.getenv("AZURE_DEPLOYMENT_WHISPER")
 OPENAI_API_VERSION = os.getenv("OPENAI_API_VERSION")
 AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
+WHISPER_MAX_RETRIES = int(os.getenv("WHISPER_MAX_RETRIES", 5))
+
+# Maximum amount of concurrent requests per deployment, shared by all threads of the process
+deployment_semaphores = {
+    AZURE_DEPLOYMENT_GPT: threading.BoundedSemaphore(int(os.getenv("AZURE_MAX_CONCURRENCY_GPT", 4))),
+    AZURE_DEPLOYMENT_WHISPER: threading.BoundedSemaphore(int(os.getenv("AZURE_MAX_CONCURRENCY_WHISPER", 2))),
+    AZURE_DEPLOYMENT_EMBEDDING: threading.BoundedSemaphore(int(os.getenv("AZURE_MAX_CONCURRENCY_EMBEDDING", 4))),
+}
+
+# the clients are created on first use, so importing this module does not need the Azure configuration
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _get_client(name, create):
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = create()
+        return _clients[name]
 
-# Define LLM Instance
-llm = AzureChatOpenAI(
-    azure_endpoint=AZURE_ENDPOINT,
-    azure_deployment=AZURE_DEPLOYMENT_GPT,
-    openai_api_version=OPENAI_API_VERSION,
-    temperature=0.1,
-    max_tokens=None,
-    timeout=None,
-    max_retries=2,
-    streaming=False,
-)
-
-# Define Whisper Instance
-client = AzureOpenAI(azure_endpoint=AZURE_ENDPOINT,
-                     api_version=OPENAI_API_VERSION,
-                     api_key=AZURE_OPENAI_API_KEY)
-
-embeddings = AzureOpenAI(
-    azure_endpoint=AZURE_ENDPOINT,
-    azure_deployment=AZURE_DEPLOYMENT_EMBEDDING,
-    api_version=OPENAI_API_VERSION,
-)
 
+@component("azure-llm")
 def get_llm():
-    return llm
+    return _get_client("llm", lambda: AzureChatOpenAI(
+        azure_endpoint=AZURE_ENDPOINT,
+        azure_deployment=AZURE_DEPLOYMENT_GPT,
+        openai_api_version=OPENAI_API_VERSION,
+        temperature=0.1,
+        max_tokens=None,
+        timeout=None,
+        max_retries=2,
+        streaming=False,
+    ))
+
+
+@component("azure-whisper")
+def get_whisper_client():
+    return _get_client("whisper", lambda: AzureOpenAI(
+        azure_endpoint=AZURE_ENDPOINT,
+        api_version=OPENAI_API_VERSION,
+        api_key=AZURE_OPENAI_API_KEY,
+    ))
+
 
 def get_llm_custom(temperature, max_tokens, timeout, max_retries, streaming):
     return AzureChatOpenAI(
@@ -50,16 +75,71 @@ def get_llm_custom(temperature, max_tokens, timeout, max_retries, streaming):
         streaming=streaming,
     )
 
+@component("azure-embeddings")
 def get_embeddings():
-    return embeddings
+    return _get_client("embeddings", lambda: AzureOpenAI(
+        azure_endpoint=AZURE_ENDPOINT,
+        azure_deployment=AZURE_DEPLOYMENT_EMBEDDING,
+        api_version=OPENAI_API_VERSION,
+    ))
+
+
+def deployment_limit(deployment):
+    """
+    limit the amount of concurrent requests to a deployment to stay within the Azure rate limits
+    usage: with deployment_limit(AZURE_DEPLOYMENT_GPT): ...
+    :param deployment: name of the Azure deployment
+    :return: semaphore of the deployment
+    """
+    return deployment_semaphores[deployment]
+
+
+def retry_after_seconds(retry_after):
+    """
+    parse a Retry-After header, it is either an amount of seconds or an HTTP-date
+    :param retry_after: value of the header
+    :return: seconds to wait or None if the header is missing or invalid
+    """
+    if not retry_after:
+        return None
+    try:
+        seconds = float(retry_after)
+        return max(0.0, seconds) if math.isfinite(seconds) else None
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
 
 
 def get_whisper(audio_file, whisper_prompt):
-    response = client.audio.transcriptions.create(
-        file=audio_file,
-        model=AZURE_DEPLOYMENT_WHISPER,
-        response_format="verbose_json",
-        prompt=whisper_prompt,
-        timestamp_granularities=["segment"]
-    )
-    return response
+    """
+    transcribe an audio file with Whisper
+    rate limited requests (429) are retried with exponential backoff or the delay requested by Azure
+    :param audio_file: opened audio file
+    :param whisper_prompt: prompt for the transcription
+    :return: verbose json transcription
+    """
+    for attempt in range(WHISPER_MAX_RETRIES + 1):
+        try:
+            with deployment_limit(AZURE_DEPLOYMENT_WHISPER):
+                audio_file.seek(0)
+                return get_whisper_client().audio.transcriptions.create(
+                    file=audio_file,
+                    model=AZURE_DEPLOYMENT_WHISPER,
+                    response_format="verbose_json",
+                    prompt=whisper_prompt,
+                    timestamp_granularities=["segment"]
+                )
+        except RateLimitError as e:
+            if attempt == WHISPER_MAX_RETRIES:
+                raise
+            delay = retry_after_seconds(e.response.headers.get("retry-after"))
+            if delay is None:
+                delay = 2 ** attempt + random.random()
+            print(f"Whisper rate limited, retrying in {delay:.1f} seconds ({attempt + 1}/{WHISPER_MAX_RETRIES})")
+            time.sleep(delay)
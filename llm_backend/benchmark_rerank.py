@@ -0,0 +1,108 @@
+"""
+Compare latency and ranking agreement of the reranker backends.
+
+Usage: python benchmark_rerank.py [queries.json] [--candidates 30] [--repeat 3] [--top-k 7]
+
+queries.json is a list of query strings. Without it a few example queries are used. The candidates of every query are
+retrieved from the vector database, so run it on a host that has the qdrant-data folder and Azure credentials.
+The PyTorch CrossEncoder is the reference, the score cache is disabled for the measured runs.
+"""
+import argparse
+import json
+import statistics
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from reranker import TorchReranker, OnnxReranker
+from vectorstore import get_vectorstore, close_vectorstore
+
+EXAMPLE_QUERIES = [
+    "The machine shows error code E04 after the filter change",
+    "Spindel läuft nach dem Werkzeugwechsel nicht mehr an",
+    "How do I calibrate the pressure sensor of the hydraulic unit?",
+    "Förderband stoppt sporadisch, Lichtschranke verschmutzt?",
+]
+
+
+def ranking(scores):
+    return sorted(range(len(scores)), key=lambda idx: scores[idx], reverse=True)
+
+
+def spearman(reference, candidate):
+    n = len(reference)
+    if n < 2:
+        return 1.0
+    reference_rank = {idx: rank for rank, idx in enumerate(ranking(reference))}
+    candidate_rank = {idx: rank for rank, idx in enumerate(ranking(candidate))}
+    d = sum((reference_rank[idx] - candidate_rank[idx]) ** 2 for idx in range(n))
+    return 1 - 6 * d / (n * (n ** 2 - 1))
+
+
+def measure(reranker, query, texts, repeat):
+    latencies = []
+    for _ in range(repeat):
+        reranker.cache.clear()
+        start = time.perf_counter()
+        scores = reranker.score(query, texts)
+        latencies.append(time.perf_counter() - start)
+    return scores, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("queries", nargs="?")
+    parser.add_argument("--candidates", type=int, default=30)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--top-k", type=int, default=7)
+    args = parser.parse_args()
+
+    queries = EXAMPLE_QUERIES
+    if args.queries:
+        with open(args.queries, "r", encoding="utf-8") as f:
+            queries = json.load(f)
+
+    vectorstore = get_vectorstore()
+    candidates = {
+        query: [hit.payload["text"] for hit in vectorstore.search_from_query(query, limit=args.candidates)]
+        for query in queries
+    }
+    close_vectorstore()
+
+    backends = [TorchReranker()]
+    try:
+        backends.append(OnnxReranker())
+    except ImportError as e:
+        print(f"ONNX backend not available: {e}")
+
+    # warm up both backends before measuring
+    for reranker in backends:
+        reranker.score(queries[0], candidates[queries[0]][:2])
+
+    results = {reranker.name: {"latencies": [], "scores": {}} for reranker in backends}
+    for query, texts in candidates.items():
+        for reranker in backends:
+            scores, latencies = measure(reranker, query, texts, args.repeat)
+            results[reranker.name]["latencies"].extend(latencies)
+            results[reranker.name]["scores"][query] = scores
+
+    reference = results["torch"]["scores"]
+    for name, result in results.items():
+        latencies = sorted(result["latencies"])
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        correlations = [spearman(reference[query], result["scores"][query]) for query in queries]
+        overlaps = [
+            len(set(ranking(reference[query])[:args.top_k]) & set(ranking(result["scores"][query])[:args.top_k]))
+            / max(1, min(args.top_k, len(reference[query])))
+            for query in queries
+        ]
+        print(
+            f"{name}: median {statistics.median(latencies) * 1000:.1f} ms, p95 {p95 * 1000:.1f} ms, "
+            f"spearman {statistics.mean(correlations):.3f}, top-{args.top_k} overlap {statistics.mean(overlaps):.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import concurrent.futures
+import json
+import os
+import tempfile
+import threading
+
+from app import app
+from webdav import download_cache, upload_cache_file
+
+# bump whenever the processing of attachments changes, older cache entries are ignored afterwards
+PIPELINE_VERSION = 2
+LLM_CACHE_MAX_MB = int(os.getenv("LLM_CACHE_MAX_MB", 2048))
+# replicate new cache entries to WebDAV in the background
+LLM_CACHE_REPLICATE = os.getenv("LLM_CACHE_REPLICATE", "false").lower() == "true"
+
+
+class ProcessingCache:
+    """
+    Local content addressed cache of processed attachments.
+    Entries are keyed by the filehash and the pipeline version, written atomically and
+    evicted least recently used first when the cache grows over its size limit.
+    """
+    def __init__(self, folder, max_bytes, replicate=False):
+        """
+        :param folder: directory of the cache files
+        :param max_bytes: maximum size of all cache files
+        :param replicate: upload new entries to the WebDAV cache in the background
+        """
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.replicate = replicate
+        self.lock = threading.Lock()
+        self.replication_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    @staticmethod
+    def key(filehash):
+        return f"{filehash}-v{PIPELINE_VERSION}"
+
+    def path(self, filehash):
+        return os.path.join(self.folder, f"{self.key(filehash)}.json")
+
+    def get(self, filehash, fetch_remote=False):
+        """
+        get a processed attachment from the cache
+        :param filehash: sha256 hash of the file
+        :param fetch_remote: download the entry of the current pipeline version from the WebDAV cache
+                             if it is not available locally
+        :return: the processed attachment as dict or None if not cached
+        """
+        path = self.path(filehash)
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                file_dict = json.load(file)
+            # mark entry as recently used
+            os.utime(path)
+            return file_dict
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+        if not fetch_remote:
+            return None
+
+        try:
+            with open(download_cache(self.key(filehash)), "r", encoding="utf-8") as file:
+                file_dict = json.load(file)
+        except Exception as e:
+            print(f"Cache entry {self.key(filehash)} not available on WebDAV: {e}")
+            return None
+        self.put(filehash, file_dict, replicate=False)
+        return file_dict
+
+    def get_legacy(self, filehash):
+        """
+        get an entry of the unversioned WebDAV cache (<filehash>), written before the pipeline version was part of the key
+        the entry is not added to the local cache, its analysis may be outdated for anything but its text
+        :param filehash: sha256 hash of the file
+        :return: the processed attachment as dict or None if not available
+        """
+        try:
+            with open(download_cache(filehash), "r", encoding="utf-8") as file:
+                return json.load(file)
+        except Exception as e:
+            print(f"Legacy cache entry {filehash} not available on WebDAV: {e}")
+            return None
+
+    def put(self, filehash, file_dict, replicate=None):
+        """
+        add a processed attachment to the cache
+        :param filehash: sha256 hash of the file
+        :param file_dict: the processed attachment
+        :param replicate: upload the entry to WebDAV, defaults to the setting of the cache
+        """
+        path = self.path(filehash)
+        # write to a temporary file first so readers never see a partially written entry
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=self.folder, suffix=".tmp", delete=False) as file:
+            json.dump(file_dict, file, ensure_ascii=False, indent=2)
+        os.replace(file.name, path)
+        self.evict()
+
+        if self.replicate if replicate is None else replicate:
+            self.replication_executor.submit(self._replicate, path, self.key(filehash))
+
+    def evict(self):
+        """
+        delete the least recently used entries until the cache is smaller than its size limit
+        """
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.folder):
+                if not name.endswith(".json"):
+                    continue
+                stat = os.stat(os.path.join(self.folder, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+            total_size = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total_size <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.folder, name))
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+
+    def _replicate(self, path, key):
+        try:
+            upload_cache_file(path, key)
+        except Exception as e:
+            print(f"Could not replicate cache entry {key} to WebDAV: {e}")
+
+
+processing_cache = ProcessingCache(
+    os.path.join(app.root_path, "cache"),
+    max_bytes=LLM_CACHE_MAX_MB * 1024 * 1024,
+    replicate=LLM_CACHE_REPLICATE,
+)
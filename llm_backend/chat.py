@@ -5,7 +5,8 @@
 from flask import jsonify
 from azure import get_llm, get_llm_custom
 from app import sio
-from sentence_transformers import CrossEncoder
+from reranker import get_reranker
+from sparse import tokenize, is_identifier
 import concurrent.futures
 import time
 import threading
@@ -13,23 +14,50 @@
 from case import Case
 from langchain_core.output_parsers import JsonOutputParser
 
-cross_encoder = CrossEncoder('cross-encoder/msmarco-MiniLM-L6-en-de-v1', max_length=512)
+# "delta" emits only the new text of the answer (llm_delta), "full" emits the whole answer for every token (llm_message)
+CHAT_STREAM_MODE = os.getenv("CHAT_STREAM_MODE", "delta")
+# deltas are collected until this many milliseconds passed or characters are buffered
+CHAT_STREAM_FLUSH_MS = int(os.getenv("CHAT_STREAM_FLUSH_MS", 50))
+CHAT_STREAM_FLUSH_CHARS = int(os.getenv("CHAT_STREAM_FLUSH_CHARS", 64))
 
-def get_cross_encoder():
-    return cross_encoder
+CITATION_START = "[doc_number:"
+
+# amount of hits per query text and the constant of the reciprocal rank fusion
+SEARCH_LIMIT_STANDARD = 5
+SEARCH_LIMIT_HYDE = 5
+SEARCH_LIMIT_MULTIPLE = 2
+RRF_K = 60
+# only the best fused hits are scored by the CrossEncoder, the rest would not reach the prompt anyway
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", 20))
+# auto: HyDE and multi-query are only generated if the identifiers of the question are not found by the first search
+QUERY_EXPANSION = os.getenv("QUERY_EXPANSION", "auto")
 
 def unique_contexts(contexts):
     unique_contexts = []
-    unique_texts = []
+    unique_texts = set()
     for context in contexts:
         if context.payload["text"] not in unique_texts:
             unique_contexts.append(context)
-            unique_texts.append(context.payload["text"])
+            unique_texts.add(context.payload["text"])
     return unique_contexts
 
-def rerank_contexts(contexts, user_query, cross_encoder_model):
-    sentence_pairs = [[user_query, hit.payload["text"]] for hit in contexts]
-    similarity_scores = cross_encoder_model.predict(sentence_pairs)
+def reciprocal_rank_fusion(result_lists, k=RRF_K):
+    """
+    merge multiple ranked result lists, every hit gets 1 / (k + rank) per list it appears in
+    :param result_lists: lists of search hits
+    :param k: constant that dampens the influence of the top ranks
+    :return: hits without duplicate point ids, sorted by their fused score
+    """
+    fused_scores = {}
+    hits = {}
+    for results in result_lists:
+        for rank, hit in enumerate(results, start=1):
+            fused_scores[hit.id] = fused_scores.get(hit.id, 0.0) + 1 / (k + rank)
+            hits.setdefault(hit.id, hit)
+    return [hits[point_id] for point_id in sorted(fused_scores, key=fused_scores.get, reverse=True)]
+
+def rerank_contexts(contexts, user_query, reranker):
+    similarity_scores = reranker.score(user_query, [hit.payload["text"] for hit in contexts])
     
     for idx in range(len(contexts)):
         contexts[idx].score = float(similarity_scores[idx])
@@ -39,7 +67,22 @@ def rerank_contexts(contexts, user_query, cross_encoder_model):
 
     return contexts
 
-def query_hyde(query, vectorstore):
+def needs_query_expansion(query, hits):
+    """
+    decide whether HyDE and multi-query are needed for a question
+    :param query: standalone question
+    :param hits: hits of the hybrid search of the question
+    :return: True if the question should be expanded
+    """
+    if QUERY_EXPANSION in ("always", "never"):
+        return QUERY_EXPANSION == "always"
+    identifiers = {token for token in tokenize(query) if is_identifier(token)}
+    if not identifiers:
+        return True
+    # model numbers, error codes and part numbers found by the lexical search are answered without expansion
+    return not any(identifiers & set(tokenize(hit.payload["text"])) for hit in hits)
+
+def generate_hyde_document(query):
     TIMEOUT_QUERY_HYDE = int(os.environ.get("TIMEOUT_QUERY_HYDE"))
     
     case_parser_json = JsonOutputParser(pydantic_object=Case)
@@ -81,11 +124,9 @@ def stream_response():
         stop_event.set()  # Signalisiert dem Thread, dass er stoppen soll
         thread.join()  # Warte darauf, dass der Thread sauber beendet wird
 
-    response_text = ''.join(response_content)
-    relevant_vectors = vectorstore.search_from_query(response_text, limit=5)
-    return relevant_vectors
+    return ''.join(response_content)
 
-def query_multiple(query, vectorstore):
+def generate_multiple_queries(query):
     prompt = "You are an AI language model assistant. Your task is to generate three different versions of the given user question to retrieve relevant documents from a vector database." \
             "By generating multiple perspectives on the user question, your goal is to help the user overcome some of the limitations of the distance-based similarity search." \
             "Provide these alternative questions separated by newlines." \
@@ -99,16 +140,7 @@ def query_multiple(query, vectorstore):
     llm = get_llm()
     response = llm(messages).content
 
-    queries = response.split("\n")
-
-    relevant_vectors = []
-    for query in queries:
-        relevant_vectors.extend(vectorstore.search_from_query(query, limit=2))
-    return relevant_vectors
-
-def query_standard(query, vectorstore):
-    relevant_vectors = vectorstore.search_from_query(query, limit=5)
-    return relevant_vectors
+    return [query for query in response.split("\n") if query.strip()]
 
 def timed(func):
     def _w(*a, **k):
@@ -119,7 +151,7 @@ def _w(*a, **k):
     return _w
 
 def ask_question(request, vectorstore):
-    cross_encoder = get_cross_encoder()
+    reranker = get_reranker()
     AMOUNT_DOCUMENTS_LLM = int(os.environ.get("AMOUNT_DOCUMENTS_LLM"))
 
     json_str = request.get_json(force=True)
@@ -138,29 +170,46 @@ def ask_question(request, vectorstore):
 
     standalone_question = transform_to_standalone_question(json.dumps(messages_only_role_content))
 
-    relevant_vectors = []
     start_time_futures = time.time()
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future_hyde = executor.submit(timed(query_hyde), standalone_question, vectorstore)
-        future_multiple = executor.submit(timed(query_multiple), standalone_question, vectorstore)
-        future_standard = executor.submit(timed(query_standard), standalone_question, vectorstore)        
-
-        time_standard, relevant_vectors_standard = future_standard.result()
-        time_hyde, relevant_vectors_hyde = future_hyde.result()
-        time_multiple, relevant_vectors_multiple = future_multiple.result()
-        print(f"Time for future_standard: {time_standard} seconds")
-        print(f"Time for future_hyde: {time_hyde} seconds")
-        print(f"Time for future_multiple: {time_multiple} seconds")
-
-        relevant_vectors.extend(relevant_vectors_standard)
-        relevant_vectors.extend(relevant_vectors_hyde)
-        relevant_vectors.extend(relevant_vectors_multiple)
-
+    queries = [standalone_question]
+    limits = [SEARCH_LIMIT_STANDARD]
+    result_lists = []
+    if QUERY_EXPANSION == "auto":
+        # the question is searched on its own first to decide whether the expansion is needed
+        time_search, result_lists = timed(vectorstore.search_queries)(queries, limits)
+        print(f"Time for search of the standalone question: {time_search} seconds")
+        queries, limits = [], []
+
+    if needs_query_expansion(standalone_question, result_lists[0] if result_lists else []):
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            future_hyde = executor.submit(timed(generate_hyde_document), standalone_question)
+            future_multiple = executor.submit(timed(generate_multiple_queries), standalone_question)
+
+            time_hyde, hyde_document = future_hyde.result()
+            time_multiple, multiple_queries = future_multiple.result()
+            print(f"Time for future_hyde: {time_hyde} seconds")
+            print(f"Time for future_multiple: {time_multiple} seconds")
+
+        if hyde_document:
+            queries.append(hyde_document)
+            limits.append(SEARCH_LIMIT_HYDE)
+        queries.extend(multiple_queries)
+        limits.extend([SEARCH_LIMIT_MULTIPLE] * len(multiple_queries))
+    else:
+        print("Identifiers of the question found, skipping query expansion")
+
+    if queries:
+        # all remaining query texts are embedded in one request and searched in one batch
+        time_search, expansion_results = timed(vectorstore.search_queries)(queries, limits)
+        print(f"Time for batch search of {len(queries)} queries: {time_search} seconds")
+        result_lists.extend(expansion_results)
     print(f"Time for futures: {time.time() - start_time_futures} seconds")
 
     start_time_rerank = time.time()
-    relevant_vectors = unique_contexts(relevant_vectors)
-    reranked_vectors = rerank_contexts(relevant_vectors, standalone_question, cross_encoder)
+    # never rerank fewer candidates than are passed to the LLM
+    rerank_candidates = max(RERANK_CANDIDATES, AMOUNT_DOCUMENTS_LLM)
+    relevant_vectors = unique_contexts(reciprocal_rank_fusion(result_lists))[:rerank_candidates]
+    reranked_vectors = rerank_contexts(relevant_vectors, standalone_question, reranker)
     end_time_rerank = time.time()
     print(f"Time for reranking: {end_time_rerank - start_time_rerank} seconds")
     
@@ -211,13 +260,18 @@ def ask_question(request, vectorstore):
     stream = llm.stream(prompt_messages)
 
     concatenated_tokens = ""
+    delta_stream = DeltaStream(replacement_dict, socket_id)
     for stream_token in stream:
         token = stream_token.content
         concatenated_tokens += token
-        edited_reponse = replace_doc_number(concatenated_tokens, replacement_dict)
-        sio.emit('llm_message', {'message': edited_reponse, 'socket_id': socket_id})
-
-    ai_message = replace_doc_number(edited_reponse, replacement_dict)
+        if CHAT_STREAM_MODE == "delta":
+            delta_stream.add(token)
+        else:
+            edited_reponse = replace_doc_number(concatenated_tokens, replacement_dict)
+            sio.emit('llm_message', {'message': edited_reponse, 'socket_id': socket_id})
+    delta_stream.finish()
+
+    ai_message = replace_doc_number(concatenated_tokens, replacement_dict)
     sio.emit('llm_end', {'message': ai_message, 'socket_id': socket_id})
 
     msg = {
@@ -225,6 +279,49 @@ def ask_question(request, vectorstore):
     }
     return jsonify(msg), 200
 
+class DeltaStream:
+    """
+    Emits the streamed answer as deltas with replaced citations.
+    Text that could be the beginning of a citation is held back until the citation is complete, so a citation split
+    over multiple tokens is replaced as a whole. The offset of a delta is the length of the answer emitted before it
+    in UTF-16 code units, the unit of JavaScript string indices.
+    """
+    def __init__(self, replacement_dict, socket_id):
+        self.replacement_dict = replacement_dict
+        self.socket_id = socket_id
+        self.pending = ""  # raw text that may contain the beginning of a citation
+        self.buffer = ""  # replaced text that is not emitted yet
+        self.offset = 0
+        self.last_flush = time.monotonic()
+
+    def add(self, token):
+        self.pending += token
+        cut = len(self.pending)
+        start = self.pending.rfind("[")
+        if start != -1:
+            tail = self.pending[start:]
+            if CITATION_START.startswith(tail) or re.fullmatch(r'\[doc_number:\d+', tail):
+                cut = start
+        self.buffer += replace_doc_number(self.pending[:cut], self.replacement_dict)
+        self.pending = self.pending[cut:]
+
+        if (len(self.buffer) >= CHAT_STREAM_FLUSH_CHARS
+                or (time.monotonic() - self.last_flush) * 1000 >= CHAT_STREAM_FLUSH_MS):
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.buffer:
+            return
+        sio.emit('llm_delta', {'message': self.buffer, 'offset': self.offset, 'socket_id': self.socket_id})
+        self.offset += len(self.buffer.encode("utf-16-le")) // 2
+        self.buffer = ""
+
+    def finish(self):
+        self.buffer += replace_doc_number(self.pending, self.replacement_dict)
+        self.pending = ""
+        self.flush()
+
 def transform_to_standalone_question(chat_history):
     system_prompt = """
         You are an AI assistant. Your task is to transform the latest human message in the chat history into a standalone question that can be understood without the previous context and in the same language it is written in.
@@ -0,0 +1,110 @@
+import functools
+import threading
+import time
+
+from app import sio
+
+PENDING = "pending"
+LOADING = "loading"
+LOADED = "loaded"
+FAILED = "failed"
+
+# name -> state of the heavy resources that are loaded on first use or by the warm-up
+components = {}
+_components_lock = threading.Lock()
+
+
+def register_component(name, loader, required=True):
+    """
+    register a resource that is loaded on first use
+    :param name: name shown by /healthz and /readyz
+    :param loader: function that loads the resource, calling it again must be cheap
+    :param required: whether the app is ready only once the resource is loaded
+    """
+    with _components_lock:
+        components[name] = {"loader": loader, "required": required, "state": PENDING, "error": None, "seconds": None}
+
+
+def component(name, required=True):
+    """
+    register the decorated getter as component, every call of the getter records the state of the component
+    usage: @component("vectorstore") def get_vectorstore(): ...
+    :param name: name shown by /healthz and /readyz
+    :param required: whether the app is ready only once the resource is loaded
+    """
+    def decorator(loader):
+        register_component(name, loader, required)
+
+        @functools.wraps(loader)
+        def load():
+            return load_component(name)
+        return load
+    return decorator
+
+
+def load_component(name):
+    """
+    load a registered resource and record its state
+    :param name: name of the component
+    :return: the loaded resource
+    """
+    component = components[name]
+    with _components_lock:
+        if component["state"] == LOADED:
+            loaded = True
+        else:
+            loaded = False
+            component["state"] = LOADING
+    if loaded:
+        return component["loader"]()
+    start = time.time()
+    try:
+        resource = component["loader"]()
+    except Exception as ex:
+        with _components_lock:
+            component["state"] = FAILED
+            component["error"] = f"{type(ex).__name__}: {ex}"
+        raise
+    with _components_lock:
+        component["seconds"] = round(time.time() - start, 2)
+        component["state"] = LOADED
+        component["error"] = None
+    return resource
+
+
+def warm_up():
+    """
+    load all registered resources in a background thread, so the first requests do not wait for them
+    """
+    def run():
+        for name in list(components):
+            try:
+                load_component(name)
+                print(f"Warm-up: {name} loaded in {components[name]['seconds']} seconds")
+            except Exception as ex:
+                print(f"Warm-up: failed to load {name}:", type(ex).__name__, ex)
+
+    thread = threading.Thread(target=run, name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+def component_status():
+    """
+    :return: state of all components and of the socket connection
+    """
+    with _components_lock:
+        status = {
+            name: {key: value for key, value in component.items() if key != "loader"}
+            for name, component in components.items()
+        }
+    status["socket"] = {"required": False, "state": "connected" if sio.connected else "disconnected"}
+    return status
+
+
+def is_ready():
+    """
+    :return: whether all required components are loaded
+    """
+    with _components_lock:
+        return all(component["state"] == LOADED for component in components.values() if component["required"])
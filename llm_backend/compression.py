@@ -0,0 +1,105 @@
+import concurrent.futures
+import json
+import os
+
+from langchain_core.prompts import ChatPromptTemplate
+
+from app import sio
+from azure import get_llm_custom, deployment_limit, AZURE_DEPLOYMENT_GPT
+from prompts import system_prompt_context_map, system_prompt_context_reduce
+from tokens import count_tokens, split_by_tokens
+
+# maximum amount of context tokens that are sent to the case generation without compression
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", 60000))
+# maximum amount of tokens of one attachment piece that is condensed in a single request
+CONTEXT_MAP_INPUT_TOKENS = int(os.getenv("CONTEXT_MAP_INPUT_TOKENS", 30000))
+# maximum length of a condensed attachment piece and of the combined context
+CONTEXT_MAP_OUTPUT_TOKENS = int(os.getenv("CONTEXT_MAP_OUTPUT_TOKENS", 4096))
+CONTEXT_REDUCE_OUTPUT_TOKENS = int(os.getenv("CONTEXT_REDUCE_OUTPUT_TOKENS", 16000))
+CONTEXT_MAX_WORKERS = int(os.getenv("CONTEXT_MAX_WORKERS", 4))
+
+
+def condense(system_prompt, content, max_tokens):
+    """
+    condense content with the LLM
+    :param system_prompt: system prompt of the map or reduce step
+    :param content: content to condense
+    :param max_tokens: maximum length of the answer
+    :return: condensed content
+    """
+    messages = [
+        ("system", "{system_prompt}"),
+        ("human", "CONTEXT: {context}"),
+    ]
+    promptLangchain = ChatPromptTemplate.from_messages(messages).partial(system_prompt=system_prompt)
+    promptLangchainInvoked = promptLangchain.invoke({"context": content})
+    llm = get_llm_custom(temperature=0, max_tokens=max_tokens, timeout=None, max_retries=2, streaming=False)
+    with deployment_limit(AZURE_DEPLOYMENT_GPT):
+        response = llm.invoke(promptLangchainInvoked)
+    return response.content
+
+
+def compress_context(context_builder, socket_id):
+    """
+    Measure the context of the case generation and compress it if it is over the token budget.
+    Map: every attachment that is larger than its share of the budget is condensed, large attachments
+    in multiple pieces, all pieces in parallel.
+    Reduce: if the condensed attachments are still over the budget they are combined into one text.
+    :param context_builder: ContextBuilder with all analyzed attachments
+    :param socket_id: socket id to send messages
+    :return: the context for the case generation
+    """
+    context = context_builder.build()
+    context_tokens = count_tokens(context)
+    print(f"Context tokens: {context_tokens} (budget: {CONTEXT_MAX_TOKENS})")
+    if context_tokens <= CONTEXT_MAX_TOKENS:
+        return context
+
+    sio.emit('llm_message', {'message': 'Condensing large attachments...', 'socket_id': socket_id})
+    attachments = context_builder.attachments
+    share_tokens = CONTEXT_MAX_TOKENS // len(attachments)
+
+    serialized = [json.dumps(file["content"], ensure_ascii=False, indent=2) for file in attachments]
+    attachment_tokens = [count_tokens(content) for content in serialized]
+
+    # map: condense all pieces of the attachments that are larger than their share
+    with concurrent.futures.ThreadPoolExecutor(max_workers=CONTEXT_MAX_WORKERS) as executor:
+        piece_futures = {}
+        for index, content in enumerate(serialized):
+            if attachment_tokens[index] <= share_tokens:
+                continue
+            pieces = split_by_tokens(content, CONTEXT_MAP_INPUT_TOKENS)
+            # every piece gets its part of the share of the attachment
+            piece_tokens = min(max(share_tokens // len(pieces), 256), CONTEXT_MAP_OUTPUT_TOKENS)
+            piece_futures[index] = [
+                executor.submit(condense, system_prompt_context_map, piece, piece_tokens) for piece in pieces
+            ]
+
+        compressed = []
+        for index, file in enumerate(attachments):
+            if index in piece_futures:
+                summary = "\n".join(future.result() for future in piece_futures[index])
+                print(f"Condensed {file['filename']}: {attachment_tokens[index]} -> {count_tokens(summary)} tokens")
+                compressed.append({**file, "content": {"condensed": summary}})
+            else:
+                compressed.append(file)
+
+    context = json.dumps(compressed, ensure_ascii=False, indent=2)
+    context_tokens = count_tokens(context)
+    print(f"Context tokens after map: {context_tokens} (budget: {CONTEXT_MAX_TOKENS})")
+    if context_tokens <= CONTEXT_MAX_TOKENS:
+        return context
+
+    # reduce: combine all condensed attachments into one text
+    sio.emit('llm_message', {'message': 'Combining condensed attachments...', 'socket_id': socket_id})
+    sections = [
+        f"file_id: {file['file_id']}, filename: {file['filename']}, mimetype: {file['mimetype']}\n"
+        + json.dumps(file["content"], ensure_ascii=False)
+        for file in compressed
+    ]
+    reduce_input = "\n\n---\n\n".join(sections)
+    # the condensed attachments are bounded by their shares, the cut only guards against the model input limit
+    reduce_input = split_by_tokens(reduce_input, CONTEXT_MAX_TOKENS * 2)[0]
+    context = condense(system_prompt_context_reduce, reduce_input, CONTEXT_REDUCE_OUTPUT_TOKENS)
+    print(f"Context tokens after reduce: {count_tokens(context)} (budget: {CONTEXT_MAX_TOKENS})")
+    return context
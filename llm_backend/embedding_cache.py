@@ -0,0 +1,164 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+# the disk store is only trimmed once it holds this fraction more entries than its limit
+DISK_EVICTION_MARGIN = 0.1
+
+
+class EmbeddingCache:
+    """
+    Cache for embedding vectors keyed by (model, sha256(text)).
+    An in-memory LRU sits in front of a persistent sqlite store, both are bounded and evict the least recently used entries.
+    Vectors are stored on disk as float32, the disk store is trimmed in batches.
+    """
+    def __init__(self, path, max_memory_entries=2048, max_disk_entries=100000):
+        """
+        :param path: path to the sqlite file of the persistent store
+        :param max_memory_entries: maximum amount of vectors kept in memory
+        :param max_disk_entries: maximum amount of vectors kept on disk
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings_f32 ("
+                "model TEXT NOT NULL, hash TEXT NOT NULL, vector BLOB NOT NULL, last_used REAL NOT NULL, "
+                "PRIMARY KEY (model, hash))"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_f32_last_used ON embeddings_f32 (last_used)")
+        self._migrate_float64()
+        self.disk_entries = self.connection.execute("SELECT COUNT(*) FROM embeddings_f32").fetchone()[0]
+
+    @staticmethod
+    def key(model, text):
+        return model, hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, model, text):
+        """
+        get a cached embedding
+        :param model: embedding model
+        :param text: embedded text
+        :return: embedding vector or None if not cached
+        """
+        key = self.key(model, text)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+
+            row = self.connection.execute(
+                "SELECT vector FROM embeddings_f32 WHERE model = ? AND hash = ?", key
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            with self.connection:
+                self.connection.execute(
+                    "UPDATE embeddings_f32 SET last_used = ? WHERE model = ? AND hash = ?", (time.time(), *key)
+                )
+            vector = array("f", row[0]).tolist()
+            self._remember(key, vector)
+            self.hits += 1
+            return vector
+
+    def put(self, model, text, vector):
+        """
+        add an embedding to the cache
+        :param model: embedding model
+        :param text: embedded text
+        :param vector: embedding vector
+        """
+        self.put_many(model, [(text, vector)])
+
+    def put_many(self, model, items):
+        """
+        add multiple embeddings to the cache with one transaction
+        :param model: embedding model
+        :param items: list of (text, vector) tuples
+        """
+        now = time.time()
+        rows = []
+        with self.lock:
+            for text, vector in items:
+                key = self.key(model, text)
+                self._remember(key, vector)
+                rows.append((*key, array("f", vector).tobytes(), now))
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO embeddings_f32 (model, hash, vector, last_used) VALUES (?, ?, ?, ?)", rows
+                )
+            # replaced entries are counted too, the exact count is only read when the limit seems to be exceeded
+            self.disk_entries += len(rows)
+            if self.disk_entries > self.max_disk_entries * (1 + DISK_EVICTION_MARGIN):
+                self._evict_disk()
+
+    def stats(self):
+        """
+        :return: hit/miss counters and current size of the cache
+        """
+        with self.lock:
+            disk_entries = self.connection.execute("SELECT COUNT(*) FROM embeddings_f32").fetchone()[0]
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_entries": len(self.memory),
+                "disk_entries": disk_entries,
+            }
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def _remember(self, key, vector):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def _evict_disk(self):
+        """
+        delete the least recently used entries down to the limit of the disk store, must be called with the lock
+        """
+        self.disk_entries = self.connection.execute("SELECT COUNT(*) FROM embeddings_f32").fetchone()[0]
+        excess = self.disk_entries - self.max_disk_entries
+        if excess <= 0:
+            return
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM embeddings_f32 WHERE rowid IN ("
+                "SELECT rowid FROM embeddings_f32 ORDER BY last_used LIMIT ?)",
+                (excess,),
+            )
+        self.disk_entries -= excess
+
+    def _migrate_float64(self):
+        """
+        convert the float64 vectors of the previous table into the float32 table
+        """
+        exists = self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'embeddings'"
+        ).fetchone()
+        if not exists:
+            return
+        self.connection.create_function("to_float32", 1, lambda blob: array("f", array("d", blob)).tobytes())
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO embeddings_f32 (model, hash, vector, last_used) "
+                "SELECT model, hash, to_float32(vector), last_used FROM embeddings"
+            )
+            self.connection.execute("DROP TABLE embeddings")
+        self.connection.execute("VACUUM")
+        print("Embedding cache converted to float32.")
@@ -7,6 +7,8 @@
 from app import sio
 from azure import get_llm
 from case import CaseArray, check_if_output_is_valid
+from compression import compress_context
+from matcher import TermMatcher
 from prompts import system_prompt_case_generation
 from upload import upload_file
 
@@ -50,93 +52,109 @@ def generate(request):
         # gets socket_id to send message to frontend
         socket_id = json_str["socket_id"]
 
-        sio.emit('llm_message', {'message': 'Starting Case Generation...', 'socket_id': socket_id})
-
-        # Prompt for generating JSON and including all context
-        prompt = "Please create metadata for a new case based on the Context provided and return them in JSON! Please try include all necessary information that the context has!"
-
-        # Instantiating AzureOpenAI object for making prompts
-        llm = get_llm()
-
-        # Upload File method converts into Context (Text)
-        context = upload_file(attachments, socket_id)
-        sio.emit('llm_message', {'message': 'Finalizing Case Generation...', 'socket_id': socket_id})
-        # validate json for multiple cases
-        case_parser_json = JsonOutputParser(pydantic_object=CaseArray)
-
-        # set system prompt and context for LLM
-        messages = [
-            ("system", "{system_prompt}\n{format_instructions}"),
-            ("human", "CONTEXT: {context}\n\nQUERY: {query}"),
-        ]
-
-        # replace system prompt and format instructions for LLM
-        promptLangchain = ChatPromptTemplate.from_messages(messages).partial(
-            system_prompt=system_prompt_case_generation,
-            format_instructions=case_parser_json.get_format_instructions(),
-        )
-
-        # invoke prompt to get an answer
-        promptLangchainInvoked = promptLangchain.invoke(
-            {"context": context, "query": prompt}
-        )
-
-        # get response
-        response_dict = start_quering_llm(
-            promptLangchainInvoked, llm, case_parser_json, max_tries=3
-        )
-
-        if "cases" in response_dict:
-            cases = response_dict["cases"]
-            attachment_files = json.loads(context)
-            add_glossary(cases, attachment_files)
-
-            # return case json
-            return jsonify(response_dict), 200
-        else:
-            abort(500, description="Couldn't get valid case output. Please add more data before trying again.")
+        response_dict = generate_cases(attachments, socket_id)
+
+        # return case json
+        return jsonify(response_dict), 200
+
+
+def generate_cases(attachments, socket_id, check_cancelled=None, on_attachment_processed=None):
+    """
+    Generate one or more cases out of the attachments
+    :param attachments: all attachments sent by user
+    :param socket_id: socket_id to send message to frontend
+    :param check_cancelled: optional callable that raises if the generation should stop
+    :param on_attachment_processed: optional callable that receives every processed attachment
+    :return: dict containing the generated cases
+    """
+    sio.emit('llm_message', {'message': 'Starting Case Generation...', 'socket_id': socket_id})
+
+    # Prompt for generating JSON and including all context
+    prompt = "Please create metadata for a new case based on the Context provided and return them in JSON! Please try include all necessary information that the context has!"
+
+    # Instantiating AzureOpenAI object for making prompts
+    llm = get_llm()
+
+    # Upload File method converts into Context (Text)
+    context_builder = upload_file(attachments, socket_id, check_cancelled, on_attachment_processed)
+    # measure the context and condense it if it is larger than the token budget
+    context = compress_context(context_builder, socket_id)
+    if check_cancelled:
+        check_cancelled()
+    sio.emit('llm_message', {'message': 'Finalizing Case Generation...', 'socket_id': socket_id})
+    # validate json for multiple cases
+    case_parser_json = JsonOutputParser(pydantic_object=CaseArray)
+
+    # set system prompt and context for LLM
+    messages = [
+        ("system", "{system_prompt}\n{format_instructions}"),
+        ("human", "CONTEXT: {context}\n\nQUERY: {query}"),
+    ]
+
+    # replace system prompt and format instructions for LLM
+    promptLangchain = ChatPromptTemplate.from_messages(messages).partial(
+        system_prompt=system_prompt_case_generation,
+        format_instructions=case_parser_json.get_format_instructions(),
+    )
+
+    # invoke prompt to get an answer
+    promptLangchainInvoked = promptLangchain.invoke(
+        {"context": context, "query": prompt}
+    )
+
+    # get response
+    response_dict = start_quering_llm(
+        promptLangchainInvoked, llm, case_parser_json, max_tries=3
+    )
+
+    if "cases" in response_dict:
+        cases = response_dict["cases"]
+        add_glossary(cases, context_builder.attachments)
+
+        return response_dict
+    else:
+        abort(500, description="Couldn't get valid case output. Please add more data before trying again.")
 
 
 
 
 def add_glossary(cases, attachment_files):
+    """
+    Add the glossary terms of the analyzed files to the generated cases and their attachments
+    A term is added to a case if it is mentioned in its solution, title or description and to an attachment
+    if it is mentioned anywhere in the analyzed file. Every text is scanned once for all terms.
+    :param cases: generated cases
+    :param attachment_files: analyzed attachments
+    """
+    files_by_id = {file["file_id"]: file for file in attachment_files}
 
-    glossary_terms = []
-    # add glossary from analyzed file to response (attachments)
+    # all glossary terms of the attachments of the cases, dict keys keep the insertion order without duplicates
+    glossary_terms = {}
     for case in cases:
         for att in case["attachments"]:
-            for file in attachment_files:
-                att_id = att["id"]
-                file_id = file["file_id"]
-                if att_id == file_id:
-                    if "glossary" in file["content"]:
-                        for term in file["content"]["glossary"]:
-                            if "glossary" not in case:
-                                att["glossary"] = []
-                            if term not in att["glossary"]:
-                                att["glossary"].append(term)
-                            if term not in glossary_terms:
-                                glossary_terms.append(term)
-
-    # check if glossary term was mentioned in solution, title or description
-    # if yes add to glossary of the case
-    for case in cases:
-        for term in glossary_terms:
-            if term in case["solution"] or term in case["title"] or term in case["description"]:
-                if "glossary" not in case:
-                    case["glossary"] = []
-                if term not in case["glossary"]:
-                    case["glossary"].append(term)
+            file = files_by_id.get(att["id"])
+            if file is not None:
+                for term in file["content"].get("glossary") or []:
+                    glossary_terms[term] = None
+
+    matcher = TermMatcher(glossary_terms)
+    # terms found in each analyzed file, every file is serialized and scanned only once
+    terms_by_file_id = {}
 
     for case in cases:
+        # check if glossary term was mentioned in solution, title or description
+        # if yes add to glossary of the case
+        case_text = "\0".join([case["solution"], case["title"], case["description"]])
+        case_terms = matcher.find(case_text)
+        if case_terms:
+            case["glossary"] = list(dict.fromkeys([*case.get("glossary", []), *case_terms]))
+
+        # add glossary terms mentioned in the analyzed file to the attachment
         for att in case["attachments"]:
-            for file in attachment_files:
-                for term in glossary_terms:
-                    att_id = att["id"]
-                    file_id = file["file_id"]
-                    if att_id == file_id:
-                        if term in json.dumps(file, ensure_ascii=False, indent=2):
-                            if "glossary" not in att:
-                                att["glossary"] = []
-                            if term not in att["glossary"]:
-                                att["glossary"].append(term)
+            file = files_by_id.get(att["id"])
+            if file is None:
+                continue
+            if att["id"] not in terms_by_file_id:
+                terms_by_file_id[att["id"]] = matcher.find(json.dumps(file, ensure_ascii=False, indent=2))
+            if terms_by_file_id[att["id"]]:
+                att["glossary"] = list(dict.fromkeys([*att.get("glossary", []), *terms_by_file_id[att["id"]]]))
@@ -1,6 +1,6 @@
 from langchain_core.prompts import ChatPromptTemplate
 
-from azure import get_llm
+from azure import get_llm, deployment_limit, AZURE_DEPLOYMENT_GPT
 from prompts import system_prompt_glossary
 
 
@@ -21,7 +21,8 @@ def generate_glossary_terms(content):
         {"context": content, "query": "Please give me the list back!"}
     )
     chain = get_llm()
-    response = chain.invoke(promptLangchainInvoked)
+    with deployment_limit(AZURE_DEPLOYMENT_GPT):
+        response = chain.invoke(promptLangchainInvoked)
     comma_seperated = response.content
     return comma_to_list(comma_seperated)
 
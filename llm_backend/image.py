@@ -2,7 +2,7 @@
 
 from langchain_core.prompts import ChatPromptTemplate
 
-from azure import get_llm
+from azure import get_llm, deployment_limit, AZURE_DEPLOYMENT_GPT
 from prompts import system_prompt_video, system_prompt_image
 
 
@@ -37,17 +37,18 @@ def image_to_openai(dict):
     chain = llm
 
     # do prompt
-    response = chain.invoke(promptLangchainInvoked)
+    with deployment_limit(AZURE_DEPLOYMENT_GPT):
+        response = chain.invoke(promptLangchainInvoked)
     vision_prompt = response.content
     return vision_prompt
 
 
-# Video to OpenAI (UNUSED)
-def video_openai(video_summary, transcription_dict):
+# Video to OpenAI, merges the summaries of the video parts into one summary
+def video_openai(video_summary, transcription_dict=None):
     """
-    :param video_summary:
-    :param transcription_dict:
-    :return:
+    :param video_summary: summaries of all video parts in timestamp order
+    :param transcription_dict: unused
+    :return: merged summary of the video
     """
 
     llm = get_llm()
@@ -74,6 +75,7 @@ def video_openai(video_summary, transcription_dict):
     chain = llm
 
     # do prompt
-    response = chain.invoke(promptLangchainInvoked)
+    with deployment_limit(AZURE_DEPLOYMENT_GPT):
+        response = chain.invoke(promptLangchainInvoked)
     vision_prompt = response.content
     return vision_prompt
@@ -0,0 +1,189 @@
+import concurrent.futures
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+from werkzeug.exceptions import HTTPException
+
+from app import app, sio
+from generate import generate_cases
+
+# maximum amount of case generations that run at the same time
+JOB_MAX_WORKERS = int(os.getenv("JOB_MAX_WORKERS", 2))
+# finished jobs are deleted after this many hours
+JOB_RETENTION_HOURS = int(os.getenv("JOB_RETENTION_HOURS", 72))
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATUSES = (SUCCEEDED, FAILED, CANCELLED)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobStore:
+    """
+    Persistent store of case generation jobs, every job is a json file that is written atomically
+    """
+    def __init__(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.lock = threading.Lock()
+
+    def path(self, job_id):
+        return os.path.join(self.folder, f"{job_id}.json")
+
+    def get(self, job_id):
+        try:
+            with open(self.path(job_id), "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def save(self, job):
+        job["updated_at"] = time.time()
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=self.folder, suffix=".tmp", delete=False) as file:
+            json.dump(job, file, ensure_ascii=False)
+        os.replace(file.name, self.path(job["id"]))
+
+    def update(self, job_id, **fields):
+        """
+        update fields of a job
+        :return: the updated job
+        """
+        with self.lock:
+            job = self.get(job_id)
+            job.update(fields)
+            self.save(job)
+            return job
+
+    def all(self):
+        jobs = []
+        for name in os.listdir(self.folder):
+            if name.endswith(".json"):
+                job = self.get(name[:-len(".json")])
+                if job is not None:
+                    jobs.append(job)
+        return jobs
+
+    def delete(self, job_id):
+        try:
+            os.remove(self.path(job_id))
+        except FileNotFoundError:
+            pass
+
+
+job_store = JobStore(os.path.join(app.root_path, "jobs"))
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=JOB_MAX_WORKERS)
+# cancel events of the jobs that are queued or running in this process
+cancel_events = {}
+
+
+def public_job(job):
+    """
+    :return: the job without its request and result
+    """
+    return {key: value for key, value in job.items() if key not in ("request", "result")}
+
+
+def submit_job(attachments, socket_id):
+    """
+    create a case generation job and queue it
+    :param attachments: all attachments sent by the user
+    :param socket_id: socket id to send progress messages to
+    :return: the created job
+    """
+    job = {
+        "id": str(uuid.uuid4()),
+        "status": QUEUED,
+        "created_at": time.time(),
+        "request": {"attachments": attachments, "socket_id": socket_id},
+        "processed_attachments": [],
+        "result": None,
+        "error": None,
+    }
+    job_store.save(job)
+    enqueue(job["id"])
+    return job
+
+
+def enqueue(job_id):
+    cancel_events[job_id] = threading.Event()
+    executor.submit(run_job, job_id)
+
+
+def run_job(job_id):
+    """
+    run a case generation job in the worker pool
+    already processed attachments are read from the processing cache, so a resumed job continues where it stopped
+    """
+    cancel_event = cancel_events[job_id]
+    job = job_store.get(job_id)
+    try:
+        if job is None or job["status"] in FINISHED_STATUSES:
+            return
+        if cancel_event.is_set():
+            job_store.update(job_id, status=CANCELLED)
+            return
+
+        job = job_store.update(job_id, status=RUNNING)
+        socket_id = job["request"]["socket_id"]
+
+        def check_cancelled():
+            if cancel_event.is_set():
+                raise JobCancelled()
+
+        def on_attachment_processed(file_as_dict):
+            with job_store.lock:
+                current = job_store.get(job_id)
+                current["processed_attachments"].append(file_as_dict["file_id"])
+                job_store.save(current)
+
+        with app.app_context():
+            result = generate_cases(job["request"]["attachments"], socket_id,
+                                    check_cancelled=check_cancelled, on_attachment_processed=on_attachment_processed)
+        job_store.update(job_id, status=SUCCEEDED, result=result)
+        sio.emit('llm_message', {'message': 'Case Generation finished', 'socket_id': socket_id})
+    except JobCancelled:
+        job_store.update(job_id, status=CANCELLED)
+    except HTTPException as e:
+        job_store.update(job_id, status=FAILED, error=e.description)
+    except Exception as e:
+        job_store.update(job_id, status=FAILED, error=str(e))
+    finally:
+        cancel_events.pop(job_id, None)
+
+
+def cancel_job(job_id):
+    """
+    cancel a queued or running job, running jobs stop before their next attachment
+    :return: the job or None if it does not exist
+    """
+    job = job_store.get(job_id)
+    if job is None or job["status"] in FINISHED_STATUSES:
+        return job
+    if job_id in cancel_events:
+        cancel_events[job_id].set()
+        return job
+    return job_store.update(job_id, status=CANCELLED)
+
+
+def resume_jobs():
+    """
+    queue all jobs that were not finished when the process stopped and delete expired jobs
+    """
+    expiration = time.time() - JOB_RETENTION_HOURS * 3600
+    for job in sorted(job_store.all(), key=lambda job: job["created_at"]):
+        if job["status"] in FINISHED_STATUSES:
+            if job["updated_at"] < expiration:
+                job_store.delete(job["id"])
+        elif job["id"] not in cancel_events:
+            print(f"Resuming job {job['id']}")
+            enqueue(job["id"])
@@ -1,12 +1,119 @@
+import atexit
+import os
+import signal
+import threading
+import time
 
-from app import app
+from app import app, start_socket
+from components import warm_up
+from jobs import resume_jobs
 from routes import routes
+from vectorstore import close_vectorstore
+
+# "development" runs the Flask debug server with reloader, "production" runs a threaded waitress server
+SERVER_MODE = os.getenv("SERVER_MODE", "development")
+# amount of worker threads handling requests
+WEB_THREADS = int(os.getenv("WEB_THREADS", 8))
+# maximum amount of open connections, further connections wait in the backlog
+WEB_CONNECTION_LIMIT = int(os.getenv("WEB_CONNECTION_LIMIT", 100))
+# seconds after which an inactive connection is closed
+WEB_CHANNEL_TIMEOUT = int(os.getenv("WEB_CHANNEL_TIMEOUT", 900))
+# seconds running requests get to finish on shutdown
+WEB_GRACEFUL_TIMEOUT = int(os.getenv("WEB_GRACEFUL_TIMEOUT", 30))
+
+
+def start_services():
+    """
+    connect the socket and warm up the shared resources in the background, then resume interrupted jobs
+    """
+    start_socket()
+    warm_up()
+    atexit.register(close_vectorstore)
+    resume_jobs()
+
+
+def create_app():
+    """
+    register all routes and start the shared resources
+    """
+    app.register_blueprint(routes)
+    start_services()
+    return app
+
+
+def serve_production():
+    """
+    serve the app with waitress: one process with a pool of worker threads, so the embedded
+    Qdrant store, the loaded models and the socket connection are shared by all requests
+    """
+    from waitress import create_server
+
+    server = create_server(
+        create_app(),
+        host="0.0.0.0",
+        port=5001,
+        threads=WEB_THREADS,
+        connection_limit=WEB_CONNECTION_LIMIT,
+        channel_timeout=WEB_CHANNEL_TIMEOUT,
+    )
+
+    stopping = threading.Event()
+
+    def shutdown(signum, frame):
+        print(f"Received signal {signum}, shutting down...")
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    def run():
+        try:
+            server.run()
+        except OSError:
+            # the sockets are closed by the main thread on shutdown
+            if not stopping.is_set():
+                raise
+
+    server_thread = threading.Thread(target=run, name="waitress", daemon=True)
+    server_thread.start()
+    print(f"Serving on http://0.0.0.0:5001 with {WEB_THREADS} threads")
+    while not stopping.wait(1):
+        if not server_thread.is_alive():
+            return
+
+    # the listening socket is closed by the server thread, so it is not closed during a select of the loop
+    listener_closed = threading.Event()
+
+    def stop_listening():
+        server.del_channel()
+        server.socket.close()
+        listener_closed.set()
+
+    server.trigger.pull_trigger(stop_listening)
+    listener_closed.wait(timeout=5)
+
+    # running requests get WEB_GRACEFUL_TIMEOUT seconds to finish, requests that were not started are cancelled
+    deadline = time.time() + WEB_GRACEFUL_TIMEOUT
+    server.task_dispatcher.shutdown(timeout=WEB_GRACEFUL_TIMEOUT)
+    # the server thread sends the rest of the finished responses within the same deadline
+    while time.time() < deadline and any(channel.writable() for channel in list(server.active_channels.values())):
+        time.sleep(0.1)
+    server.close()
+    server_thread.join(timeout=1)
+
 
 def init_flask():
     """
     start flask and make it available to the local network
     """
+    if SERVER_MODE == "production":
+        serve_production()
+        return
+
     app.register_blueprint(routes)
+    # the debug reloader runs the app in a child process, only the serving process opens the vectorstore
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_services()
     app.run(host="0.0.0.0", port=5001, debug=True)
 
 
@@ -0,0 +1,59 @@
+from collections import deque
+
+
+class TermMatcher:
+    """
+    Aho-Corasick automaton to find many terms in a text with a single scan.
+    The automaton is built once for all terms, matching a text takes linear time in the text length plus the matches.
+    """
+    def __init__(self, terms):
+        """
+        :param terms: terms to search for, empty terms are ignored
+        """
+        self.terms = [term for term in dict.fromkeys(terms) if term]
+        # goto transitions, failure links and the indices of the terms that end in each node
+        self.transitions = [{}]
+        self.failure = [0]
+        self.outputs = [[]]
+
+        for term_index, term in enumerate(self.terms):
+            node = 0
+            for char in term:
+                next_node = self.transitions[node].get(char)
+                if next_node is None:
+                    next_node = len(self.transitions)
+                    self.transitions[node][char] = next_node
+                    self.transitions.append({})
+                    self.failure.append(0)
+                    self.outputs.append([])
+                node = next_node
+            self.outputs[node].append(term_index)
+
+        # breadth first, so the failure link of the parent is known before its children are visited
+        queue = deque(self.transitions[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.transitions[node].items():
+                queue.append(child)
+                fallback = self.failure[node]
+                while fallback and char not in self.transitions[fallback]:
+                    fallback = self.failure[fallback]
+                self.failure[child] = self.transitions[fallback].get(char, 0)
+                # a match ending in the child also includes all matches ending in its failure node
+                self.outputs[child] = self.outputs[child] + self.outputs[self.failure[child]]
+
+    def find(self, text):
+        """
+        find all terms that occur in the text
+        :param text: text to scan
+        :return: the found terms in the order they were given to the matcher
+        """
+        found = set()
+        node = 0
+        for char in text:
+            while node and char not in self.transitions[node]:
+                node = self.failure[node]
+            node = self.transitions[node].get(char, 0)
+            if self.outputs[node]:
+                found.update(self.outputs[node])
+        return [self.terms[index] for index in sorted(found)]
@@ -1,21 +1,25 @@
-import json
 import re
 
 import pdfplumber
 from flask import abort
 
-from readwrite import read_from_file
-from webdav import download_cache
+from cache import processing_cache
+from upload import process_file
 
 
-def process_attachment(file):
+def process_attachment(file, socket_id=None):
     mimetype = file["mimetype"]
     filehash = file["filehash"]
     file_id = file["id"] if "id" in file else file["file_id"]
 
-    path = download_cache(filehash)
-    content_of_file = read_from_file(path)
-    file_dict = json.loads(content_of_file)
+    # processed attachments are read from the local cache, the WebDAV cache is only used on a local miss
+    file_dict = processing_cache.get(filehash, fetch_remote=True)
+    if file_dict is None:
+        # attachments analyzed before the pipeline version was part of the cache key, only their text is needed here
+        file_dict = processing_cache.get_legacy(filehash)
+    if file_dict is None:
+        # evicted locally and not replicated, the attachment is analyzed again
+        file_dict = process_file({**file, "id": file_id}, [], socket_id)
     file_dict["file_id"] = file_id
 
     if "audio" in mimetype:
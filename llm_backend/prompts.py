@@ -121,3 +121,27 @@
 
 """
 
+
+# system prompt to condense a single attachment when the context of the case generation is too large
+system_prompt_context_map = """
+You are an assistant that condenses documents for a case generation system about machine problems and their solutions.
+The CONTEXT is (a part of) one analyzed attachment: a document text, an audio transcription or a video summary.
+
+Rewrite it as a condensed version that keeps:
+- Every described problem, error, symptom and cause.
+- Every solution, repair step and check that was performed.
+- Machine names, product names, model numbers, error codes and part numbers exactly as written.
+- The timestamps of audio transcriptions in the format `[start_timestamp - end_timestamp]` next to the information they belong to.
+
+Leave out greetings, repetitions and content unrelated to machines. Do not add any information that is not in the CONTEXT.
+"""
+
+# system prompt to combine the condensed attachments when they are still too large
+system_prompt_context_reduce = """
+You are an assistant that combines condensed documents for a case generation system about machine problems and their solutions.
+The CONTEXT contains several condensed attachments, each one starts with its file_id and filename.
+
+Combine them into one shorter text. Keep the file_id and filename headers so every piece of information can still be
+attributed to its attachment. Keep problems, solutions, machine names, model numbers, error codes and timestamps of audio
+transcriptions. Do not add any information that is not in the CONTEXT.
+"""
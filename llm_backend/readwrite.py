@@ -1,6 +1,7 @@
 import json
 import os
 import shutil
+import time
 
 from flask import abort
 
@@ -35,6 +36,32 @@ def write_to_file(hash, content):
         abort(500, description=f"An error occurred: {e}")
 
 
+# write a debug snapshot
+def write_debug_snapshot(content, max_snapshots):
+    """
+    write content to a new snapshot in temp/debug, only the newest snapshots are kept
+    :param content: content of the snapshot
+    :param max_snapshots: maximum amount of snapshots
+    :return: file_path to the snapshot
+    """
+    dir_path = os.path.join(app.root_path, temp_folder, "debug")
+    os.makedirs(dir_path, exist_ok=True)
+
+    file_path = os.path.join(dir_path, f"{time.time()}.json")
+    try:
+        with open(file_path, "w", encoding="utf-8") as file:
+            file.write(content)
+    except Exception as e:
+        print(f"Could not write debug snapshot: {e}")
+        return None
+
+    # delete the oldest snapshots
+    snapshots = sorted(os.listdir(dir_path), key=lambda name: float(name[:-len(".json")]))
+    for name in snapshots[:-max_snapshots]:
+        os.remove(os.path.join(dir_path, name))
+    return file_path
+
+
 # delete temp folder
 def delete_temp_folder(hash):
     """
@@ -0,0 +1,187 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from app import app
+from components import component
+
+RERANK_MODEL = os.getenv("RERANK_MODEL", "cross-encoder/msmarco-MiniLM-L6-en-de-v1")
+# auto: use the int8 ONNX model, the PyTorch CrossEncoder if it can not be exported or loaded
+RERANK_BACKEND = os.getenv("RERANK_BACKEND", "auto")
+RERANK_MAX_LENGTH = int(os.getenv("RERANK_MAX_LENGTH", 512))
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", 16))
+# 0 keeps the default thread count of the backend
+RERANK_THREADS = int(os.getenv("RERANK_THREADS", 0))
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", 4096))
+
+onnx_model_folder = os.path.join(app.root_path, "onnx-models")
+
+
+class Reranker:
+    """
+    Base class of the reranker backends.
+    Scores are cached per (query, sha256(text)) and missing pairs are scored in batches of similar length,
+    so short chunks are not padded to the length of the longest chunk of the query.
+    """
+    name = "base"
+
+    def __init__(self, batch_size=RERANK_BATCH_SIZE, cache_size=RERANK_CACHE_SIZE):
+        """
+        :param batch_size: maximum amount of pairs scored in one forward pass
+        :param cache_size: maximum amount of cached scores
+        """
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def predict_batch(self, query, texts):
+        """
+        score one batch of texts against the query
+        :param query: query
+        :param texts: list of texts
+        :return: list of float scores
+        """
+        raise NotImplementedError
+
+    def score(self, query, texts):
+        """
+        score texts against the query
+        :param query: query
+        :param texts: list of texts
+        :return: list of float scores in the order of the texts
+        """
+        keys = [(query, hashlib.sha256(text.encode("utf-8")).hexdigest()) for text in texts]
+        scores = [None] * len(texts)
+        missing = []
+        with self.lock:
+            for idx, key in enumerate(keys):
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    scores[idx] = self.cache[key]
+                else:
+                    missing.append(idx)
+
+        # sort by length so every batch is padded to a similar length
+        missing.sort(key=lambda idx: len(texts[idx]))
+        computed = {}
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            batch_scores = self.predict_batch(query, [texts[idx] for idx in batch])
+            for idx, batch_score in zip(batch, batch_scores):
+                scores[idx] = float(batch_score)
+                computed[keys[idx]] = scores[idx]
+
+        with self.lock:
+            for key, value in computed.items():
+                self.cache[key] = value
+                self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        print(f"Rerank ({self.name}): {len(texts) - len(missing)} cached, {len(missing)} scored")
+        return scores
+
+
+class TorchReranker(Reranker):
+    """
+    PyTorch CrossEncoder from sentence-transformers.
+    """
+    name = "torch"
+
+    def __init__(self, model_name=RERANK_MODEL, max_length=RERANK_MAX_LENGTH, threads=RERANK_THREADS, **kwargs):
+        super().__init__(**kwargs)
+        import torch
+        from sentence_transformers import CrossEncoder
+
+        if threads > 0:
+            torch.set_num_threads(threads)
+        self.model = CrossEncoder(model_name, max_length=max_length)
+
+    def predict_batch(self, query, texts):
+        return self.model.predict([[query, text] for text in texts], batch_size=len(texts), show_progress_bar=False)
+
+
+class OnnxReranker(Reranker):
+    """
+    Dynamically int8-quantized ONNX export of the CrossEncoder, run with onnxruntime.
+    The export and quantization happen once, the result is stored in onnx-models/.
+    """
+    name = "onnx"
+
+    def __init__(self, model_name=RERANK_MODEL, max_length=RERANK_MAX_LENGTH, threads=RERANK_THREADS, **kwargs):
+        super().__init__(**kwargs)
+        import onnxruntime
+        from optimum.onnxruntime import ORTModelForSequenceClassification, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+
+        model_folder = os.path.join(onnx_model_folder, model_name.replace("/", "__"))
+        quantized_file = os.path.join(model_folder, "model_quantized.onnx")
+        if not os.path.exists(quantized_file):
+            print(f"Exporting {model_name} to ONNX...")
+            model = ORTModelForSequenceClassification.from_pretrained(model_name, export=True)
+            model.save_pretrained(model_folder)
+            AutoTokenizer.from_pretrained(model_name).save_pretrained(model_folder)
+            quantizer = ORTQuantizer.from_pretrained(model_folder)
+            quantizer.quantize(
+                save_dir=model_folder,
+                quantization_config=AutoQuantizationConfig.avx2(is_static=False, per_channel=False),
+            )
+
+        session_options = onnxruntime.SessionOptions()
+        if threads > 0:
+            session_options.intra_op_num_threads = threads
+            session_options.inter_op_num_threads = 1
+        self.model = ORTModelForSequenceClassification.from_pretrained(
+            model_folder, file_name="model_quantized.onnx", session_options=session_options
+        )
+        self.tokenizer = AutoTokenizer.from_pretrained(model_folder)
+        self.max_length = max_length
+
+    def predict_batch(self, query, texts):
+        import numpy as np
+
+        features = self.tokenizer(
+            [query] * len(texts), texts, padding=True, truncation="only_second",
+            max_length=self.max_length, return_tensors="pt"
+        )
+        logits = self.model(**features).logits.detach().numpy()[:, 0]
+        # the CrossEncoder applies a sigmoid to single label models
+        return 1 / (1 + np.exp(-logits))
+
+
+def create_reranker(backend=RERANK_BACKEND, **kwargs):
+    """
+    create a reranker backend
+    :param backend: auto, onnx or torch
+    :param kwargs: arguments of the backend
+    :return: Reranker
+    """
+    if backend in ("auto", "onnx"):
+        try:
+            return OnnxReranker(**kwargs)
+        except Exception as e:
+            if backend == "onnx":
+                raise
+            print(f"ONNX reranker not available ({type(e).__name__}: {e}), falling back to the PyTorch CrossEncoder")
+    return TorchReranker(**kwargs)
+
+
+_reranker = None
+_reranker_lock = threading.Lock()
+
+
+@component("reranker")
+def get_reranker():
+    """
+    get the reranker of the process, it is created on first use
+    :return: Reranker
+    """
+    global _reranker
+    with _reranker_lock:
+        if _reranker is None:
+            _reranker = create_reranker()
+            print(f"Reranker backend: {_reranker.name}")
+        return _reranker
@@ -1,12 +1,20 @@
-from flask import request, Blueprint, jsonify
+import json
+import os
+
+from flask import request, Blueprint, jsonify, Response
 
 from app import app, sio
 from generate import generate
 from chat import ask_question
-from vectorstore import QdrantVectorstore, vector_db_save_cases, delete_entries_from_vector_db
+from components import component_status, is_ready
+from jobs import submit_job, cancel_job, job_store, public_job, SUCCEEDED, FINISHED_STATUSES
+from vectorstore import get_vectorstore, vector_db_save_cases, delete_entries_from_vector_db
 
 routes = Blueprint("routes", __name__)
 
+# larger limits of /show_all_entries are reduced to this page size
+SHOW_ENTRIES_MAX_LIMIT = int(os.getenv("SHOW_ENTRIES_MAX_LIMIT", 1000))
+
 ### Defining Routes
 
 @app.route("/test", methods=["GET"])
@@ -19,6 +27,23 @@ def test():
         return str(ex)
 
 
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """
+    the process is up, reports which components are loaded
+    """
+    return jsonify({"status": "ok", "components": component_status()}), 200
+
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    """
+    200 once all required components are loaded, 503 before
+    """
+    ready = is_ready()
+    return jsonify({"ready": ready, "components": component_status()}), 200 if ready else 503
+
+
 # generate_case: Endpoint to send all files so the LLM can analyze and process them
 # returns json array containing one or more cases
 @app.route("/generate_case", methods=["POST"])
@@ -27,35 +52,103 @@ def generate_case():
         return generate(request)
 
 
+# jobs/generate_case: Endpoint to start the case generation in the background
+# returns the job id, progress is sent over the socket and the status can be polled
+@app.route("/jobs/generate_case", methods=["POST"])
+def submit_generate_case_job():
+    json_str = request.get_json(force=True)
+    job = submit_job(json_str["attachments"], json_str["socket_id"])
+    return jsonify(public_job(job)), 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job_status(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify(message=f"Job {job_id} not found"), 404
+    return jsonify(public_job(job)), 200
+
+
+# returns the generated cases in the same format as /generate_case once the job succeeded
+@app.route("/jobs/<job_id>/result", methods=["GET"])
+def get_job_result(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify(message=f"Job {job_id} not found"), 404
+    if job["status"] == SUCCEEDED:
+        return jsonify(job["result"]), 200
+    if job["status"] in FINISHED_STATUSES:
+        return jsonify(public_job(job)), 409
+    return jsonify(public_job(job)), 202
+
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_generate_case_job(job_id):
+    job = cancel_job(job_id)
+    if job is None:
+        return jsonify(message=f"Job {job_id} not found"), 404
+    return jsonify(public_job(job)), 200
+
+
 # chat: Endpoint for searching Cases
 # returns complete message generated by the LLM
 # implements sockets so the Frontend receives tokens    
 @app.route("/generate", methods=["POST"])
 def ask_question_():
     if request.method == "POST":
-        with QdrantVectorstore() as vectorstore:
-            return ask_question(request, vectorstore)
+        return ask_question(request, get_vectorstore())
 
 
 @app.route("/save_to_vector_db", methods=["POST"])
 def save_to_vector_db():
     if request.method == "POST":
-        with QdrantVectorstore() as vectorstore:
-            return vector_db_save_cases(request, vectorstore)
+        return vector_db_save_cases(request, get_vectorstore())
 
 @app.route("/delete_from_vector_db", methods=["POST"])
 def delete_from_vector_db():
     if request.method == "POST":
-        with QdrantVectorstore() as vectorstore:
-            return delete_entries_from_vector_db(request, vectorstore)
+        return delete_entries_from_vector_db(request, get_vectorstore())
       
+# show_all_entries: streams the entries of the vector database as NDJSON, one entry per line
+# optional query parameters: offset (cursor of the previous response), limit, fields (comma separated payload keys),
+# with_vectors (true/false), the last line contains the cursor of the next page: {"next_offset": ...}
 @app.route("/show_all_entries", methods=["GET"])
 def show_all_entries():
-    with QdrantVectorstore() as vectorstore:
-        entries = vectorstore.show_all_entries()
-        # Convert each entry to a string
-        data = [str(entry) for entry in entries]
-        return jsonify(data), 200
+    offset = request.args.get("offset")
+    if offset is not None and offset.isdigit():
+        offset = int(offset)
+    limit = request.args.get("limit")
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            return jsonify(message="limit must be a positive integer"), 400
+        if limit <= 0:
+            return jsonify(message="limit must be a positive integer"), 400
+        limit = min(limit, SHOW_ENTRIES_MAX_LIMIT)
+    fields = request.args.get("fields")
+    fields = [field for field in fields.split(",") if field] if fields is not None else None
+    with_vectors = request.args.get("with_vectors", "false").lower() == "true"
+    vectorstore = get_vectorstore()
+
+    def generate_lines():
+        next_offset = None
+        for records, next_offset in vectorstore.iter_entry_pages(offset, limit, fields, with_vectors):
+            for record in records:
+                entry = {"id": record.id, "payload": record.payload}
+                if with_vectors:
+                    entry["vector"] = entry_vector_to_json(record.vector)
+                yield json.dumps(entry, ensure_ascii=False) + "\n"
+        yield json.dumps({"next_offset": next_offset}) + "\n"
+
+    return Response(generate_lines(), mimetype="application/x-ndjson")
+
+
+def entry_vector_to_json(vector):
+    if isinstance(vector, dict):
+        return {name: entry_vector_to_json(value) for name, value in vector.items()}
+    # sparse vectors are pydantic models
+    return vector.model_dump() if hasattr(vector, "model_dump") else vector
 
 
 @app.errorhandler(500)
@@ -0,0 +1,74 @@
+import re
+import zlib
+from collections import Counter
+
+from qdrant_client.models import SparseVector
+
+# BM25 parameters, the IDF part is applied by Qdrant (Modifier.IDF) at search time
+BM25_K1 = 1.2
+BM25_B = 0.75
+# documents are chunks of similar size, so a fixed average length is used instead of collection statistics
+BM25_AVERAGE_LENGTH = 256
+
+# words and identifiers like "MIG4300Pro", "E-04", "6ES7-214" or "v2.1"
+TOKEN_PATTERN = re.compile(r"\w+(?:[-./]\w+)*")
+SUB_TOKEN_PATTERN = re.compile(r"[-./]")
+
+
+def tokenize(text):
+    """
+    split a text into lowercase tokens
+    identifiers that contain separators are kept as a whole and additionally split into their parts
+    :param text: text to tokenize
+    :return: list of tokens
+    """
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(text.lower()):
+        token = match.group(0)
+        tokens.append(token)
+        parts = SUB_TOKEN_PATTERN.split(token)
+        if len(parts) > 1:
+            tokens.extend(part for part in parts if part)
+    return tokens
+
+
+def is_identifier(token):
+    """
+    identifiers like model numbers, error codes and part numbers contain digits
+    :param token: lowercase token
+    :return: whether the token looks like an identifier
+    """
+    return len(token) >= 3 and any(char.isdigit() for char in token)
+
+
+def token_index(token):
+    return zlib.crc32(token.encode("utf-8"))
+
+
+def _to_sparse_vector(weights):
+    indices = sorted(weights)
+    return SparseVector(indices=indices, values=[weights[index] for index in indices])
+
+
+def document_vector(text):
+    """
+    BM25 term frequency weights of a document, hashed into the sparse index space
+    :param text: document text
+    :return: SparseVector
+    """
+    tokens = tokenize(text)
+    length_norm = BM25_K1 * (1 - BM25_B + BM25_B * len(tokens) / BM25_AVERAGE_LENGTH)
+    weights = {}
+    for token, frequency in Counter(tokens).items():
+        index = token_index(token)
+        weights[index] = weights.get(index, 0.0) + frequency * (BM25_K1 + 1) / (frequency + length_norm)
+    return _to_sparse_vector(weights)
+
+
+def query_vector(text):
+    """
+    every distinct query token gets the weight 1, Qdrant multiplies it with the IDF of the token
+    :param text: query text
+    :return: SparseVector
+    """
+    return _to_sparse_vector({token_index(token): 1.0 for token in set(tokenize(text))})
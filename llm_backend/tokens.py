@@ -0,0 +1,65 @@
+import os
+from functools import lru_cache
+
+# tiktoken downloads its BPE files on first use, they are kept next to the app so they can be fetched
+# once during the container setup (python tokens.py) and are available without network access afterwards
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tiktoken-cache"))
+
+import tiktoken
+
+# the chat deployment is named after its model, gpt-4o uses the o200k_base encoding
+CHAT_MODEL = os.getenv("AZURE_DEPLOYMENT_GPT", "gpt-4o")
+FALLBACK_ENCODING = "o200k_base"
+# encodings of the chat model and the embedding model (text-embedding-ada-002)
+PREFETCH_ENCODINGS = ["o200k_base", "cl100k_base"]
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model=CHAT_MODEL):
+    """
+    load the tiktoken encoding of a model once and keep it for the lifetime of the process
+    :param model: name of the model, unknown names use the encoding of gpt-4o
+    :return: tiktoken encoding
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding(FALLBACK_ENCODING)
+
+
+def count_tokens(text, model=CHAT_MODEL):
+    """
+    count the tokens of a text with a local tokenizer
+    :param text: text to count
+    :param model: name of the model the text is sent to
+    :return: amount of tokens
+    """
+    if not text:
+        return 0
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+
+def split_by_tokens(text, max_tokens, model=CHAT_MODEL):
+    """
+    split a text into pieces of at most max_tokens tokens
+    :param text: text to split
+    :param max_tokens: maximum amount of tokens per piece
+    :param model: name of the model the text is sent to
+    :return: list of text pieces
+    """
+    encoding = get_encoding(model)
+    tokens = encoding.encode(text, disallowed_special=())
+    return [encoding.decode(tokens[start:start + max_tokens]) for start in range(0, len(tokens), max_tokens)]
+
+
+def prefetch_encodings():
+    """
+    download the BPE files of all used encodings into TIKTOKEN_CACHE_DIR
+    """
+    for encoding_name in PREFETCH_ENCODINGS:
+        tiktoken.get_encoding(encoding_name)
+        print(f"Fetched tiktoken encoding {encoding_name} into {os.environ['TIKTOKEN_CACHE_DIR']}")
+
+
+if __name__ == "__main__":
+    prefetch_encodings()
@@ -1,158 +1,244 @@
+import concurrent.futures
 import json
 import mimetypes
-import time
+import os
 from bs4 import BeautifulSoup
 
 from app import sio
+from cache import processing_cache
 from glossary import generate_glossary_terms
 from image import encode_image, image_to_openai
 from pdf import create_text_chunks_pdfplumber
-from readwrite import write_to_file, read_from_file, text_to_dict, delete_temp_folder
-from video import process_segments, extract_data_from_video, get_all_frames_in_dir
-from webdav import check_if_cached, download_cache, upload_cache_file, download_file_webdav
+from readwrite import write_debug_snapshot, delete_temp_folder
+from video import process_segments, extract_data_from_video, get_all_frames_in_dir, sample_frames
+from webdav import download_file_webdav
 from whisper import transcribe
 
-USE_CACHE = False
+# maximum amount of attachments that are processed at the same time
+UPLOAD_MAX_WORKERS = int(os.getenv("UPLOAD_MAX_WORKERS", 4))
+# amount of context snapshots kept in temp/debug, 0 disables the snapshots
+DEBUG_CONTEXT_SNAPSHOTS = int(os.getenv("DEBUG_CONTEXT_SNAPSHOTS", 0))
 
 
-def upload_file(files, socket_id):
+class ContextBuilder:
+    """
+    Builds the context of the case generation out of the analyzed attachments.
+    Every attachment is serialized once when it is added, the context is the same as
+    json.dumps(attachments, ensure_ascii=False, indent=2) of all attachments ordered by their position.
+    """
+    def __init__(self):
+        self.parts = {}
+        self.files = {}
+
+    def add(self, position, file_as_dict):
+        """
+        :param position: position of the attachment in the context
+        :param file_as_dict: the analyzed attachment
+        """
+        serialized = json.dumps(file_as_dict, ensure_ascii=False, indent=2)
+        # indent by one level because the attachment is an element of the list
+        self.parts[position] = "\n".join("  " + line for line in serialized.split("\n"))
+        self.files[position] = file_as_dict
+
+    @property
+    def attachments(self):
+        return [self.files[position] for position in sorted(self.files)]
+
+    def build(self):
+        """
+        :return: the context as json string
+        """
+        if not self.parts:
+            return "[]"
+        return "[\n" + ",\n".join(self.parts[position] for position in sorted(self.parts)) + "\n]"
+
+
+def upload_file(files, socket_id, check_cancelled=None, on_attachment_processed=None):
     """
     Upload method
+    Independent attachments are processed in parallel by a bounded worker pool.
+    Audio and video files are processed after all other files, so the glossary terms of the
+    text based files can be used as prompt for the Whisper transcription.
     :param files: all attachments
     :param socket_id: socket id to send messages
-    :return: all generated cases
+    :param check_cancelled: optional callable that raises if the processing should stop, checked before every attachment
+    :param on_attachment_processed: optional callable that receives every processed attachment
+    :return: ContextBuilder containing all analyzed attachments
     """
-    attachments = []
-    single_file = {}
-    files_json = ""
-
     # sort all attachments so textbased files will be analyzed first
     sorted_attachments = sorted(files, key=sort_attachments)
+    results = [None] * len(sorted_attachments)
+    context_builder = ContextBuilder()
+
+    def process_stage(executor, indices, analyzed_attachments):
+        # attachments with the same filehash are only processed once
+        futures = {}
+        for index in indices:
+            file_hash = sorted_attachments[index]["filehash"]
+            if file_hash not in futures:
+                futures[file_hash] = executor.submit(
+                    process_file, sorted_attachments[index], analyzed_attachments, socket_id, check_cancelled
+                )
+        for index in indices:
+            file = sorted_attachments[index]
+            file_as_dict = futures[file["filehash"]].result()
+            results[index] = {
+                **file_as_dict,
+                "filename": file["filename"],
+                "filepath": file["filepath"],
+                "file_id": file["id"],
+            }
+            context_builder.add(index, results[index])
+            if on_attachment_processed:
+                on_attachment_processed(results[index])
+
+    transcription_indices = [index for index, file in enumerate(sorted_attachments) if needs_transcription(file)]
+    other_indices = [index for index in range(len(sorted_attachments)) if index not in transcription_indices]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=UPLOAD_MAX_WORKERS) as executor:
+        process_stage(executor, other_indices, [])
+        analyzed_attachments = [results[index] for index in other_indices]
+        process_stage(executor, transcription_indices, analyzed_attachments)
+
+    if DEBUG_CONTEXT_SNAPSHOTS > 0:
+        write_debug_snapshot(context_builder.build(), DEBUG_CONTEXT_SNAPSHOTS)
+
+    return context_builder
+
+
+def process_file(file, analyzed_attachments, socket_id, check_cancelled=None):
+    """
+    Download and analyze a single attachment
+    :param file: attachment to process
+    :param analyzed_attachments: attachments that already have been analyzed, used for the glossary of the transcription
+    :param socket_id: socket id to send messages
+    :param check_cancelled: optional callable that raises if the processing should stop
+    :return: the attachment as dictionary containing the analyzed content
+    """
+    if check_cancelled:
+        check_cancelled()
 
-    # iterate over all sorted attachments
-    for file in sorted_attachments:
-        file_mimetype = file["mimetype"]
-        file_id = file["id"]
-        file_name = file["filename"]
-        file_path = file["filepath"]
-        file_hash = file["filehash"]
-
-        delete_temp_folder(file_hash)
-
-
-        sio.emit('llm_message', {'message': f'Getting File: "{file_name}"', 'socket_id': socket_id})
-        path = download_file_webdav(file_path, file_name)
-        is_cached = check_if_cached(file_hash)
-
-        sio.emit('llm_message', {'message': f'Analyzing "{file_name}"', 'socket_id': socket_id})
-
-        if not is_cached or not USE_CACHE:
-            # upload audio file
-            if "audio" in file_mimetype:
-                sio.emit('llm_message', {'message': f'Transcribing Audio File "{file_name}"', 'socket_id': socket_id})
-                transcription = transcribe(path, file_hash, attachments, socket_id)
-                single_file = transcription
-            # upload pdf file
-            elif "pdf" in file_mimetype:
-                sio.emit('llm_message', {'message': f'Analyzing PDF File "{file_name}"', 'socket_id': socket_id})
-                single_text = create_text_chunks_pdfplumber(path)
-                glossary_terms = generate_glossary_terms(single_text)
-                single_file = {
-                    "text": single_text,
-                    "glossary": glossary_terms
-                }
-            # upload html file
-            elif "html" in file_mimetype:
-                sio.emit('llm_message', {'message': f'Analyzing HTML File "{file_name}"', 'socket_id': socket_id})
-                with open(path, "r", encoding="utf-8") as f:
-                    contents = f.read()
-                    soup = BeautifulSoup(contents)
-                    single_text = soup.get_text()
-                    glossary_terms = generate_glossary_terms(single_text)
-                single_file = {
-                    "text": single_text,
-                    "glossary": glossary_terms
-                }
-            # upload text file
-            elif file_mimetype == "text/plain":
-                sio.emit('llm_message', {'message': f'Analyzing Text File "{file_name}"', 'socket_id': socket_id})
-                with open(path, "r", encoding="utf-8") as f:
-                    contents = f.read()
-                    single_text = contents
-                    glossary_terms = generate_glossary_terms(single_text)
-                single_file = {
-                    "text": single_text,
-                    "glossary": glossary_terms
-                }
-            # upload image file
-            elif "image" in file_mimetype:
-                sio.emit('llm_message', {'message': f'Analyzing Image File "{file_name}"', 'socket_id': socket_id})
-                encoding = encode_image(path)
-                mime_type = mimetypes.guess_type(path)[0]
-                prompt_dict = [
-                    {
-                        "type": "text",
-                        "text": "What is this image showing, be as detailed as possible"
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:{mime_type};base64,{encoding}",
-                            "detail": "auto"
-                        }
-                    }
-                ]
-                single_text = image_to_openai(prompt_dict)
-                single_file = {
-                    "image": single_text
-                }
-            # upload video file
-            elif "video" in file_mimetype:
-                sio.emit('llm_message', {'message': f'Analyzing Video File "{file_name}"', 'socket_id': socket_id})
-
-                frame_path, audio_path, duration = extract_data_from_video(path, file_hash)
-                frames = get_all_frames_in_dir(frame_path)
-
-                transcription = transcribe(audio_path, file_hash, attachments, socket_id)
-                video_summary = process_segments(frames, transcription, duration, socket_id)
-                single_file = {
-                    "transcription": transcription["transcription"],
-                    "video_summary": video_summary["video_summary"]
+    single_file = {}
+    file_mimetype = file["mimetype"]
+    file_id = file["id"]
+    file_name = file["filename"]
+    file_path = file["filepath"]
+    file_hash = file["filehash"]
+
+    ### CACHE TO MINIMIZE AZURE API CALLS
+    cached_file = processing_cache.get(file_hash)
+    if cached_file is not None:
+        sio.emit('llm_message', {'message': f'Getting "{file_name}" from Cache', 'socket_id': socket_id})
+        return cached_file
+
+    delete_temp_folder(file_hash)
+
+
+    sio.emit('llm_message', {'message': f'Getting File: "{file_name}"', 'socket_id': socket_id})
+    # prefix the filehash so parallel downloads of files with the same name do not overwrite each other
+    path = download_file_webdav(file_path, f"{file_hash}_{file_name}")
+
+    sio.emit('llm_message', {'message': f'Analyzing "{file_name}"', 'socket_id': socket_id})
+
+    # upload audio file
+    if "audio" in file_mimetype:
+        sio.emit('llm_message', {'message': f'Transcribing Audio File "{file_name}"', 'socket_id': socket_id})
+        transcription = transcribe(path, file_hash, analyzed_attachments, socket_id)
+        single_file = transcription
+    # upload pdf file
+    elif "pdf" in file_mimetype:
+        sio.emit('llm_message', {'message': f'Analyzing PDF File "{file_name}"', 'socket_id': socket_id})
+        single_text = create_text_chunks_pdfplumber(path)
+        glossary_terms = generate_glossary_terms(single_text)
+        single_file = {
+            "text": single_text,
+            "glossary": glossary_terms
+        }
+    # upload html file
+    elif "html" in file_mimetype:
+        sio.emit('llm_message', {'message': f'Analyzing HTML File "{file_name}"', 'socket_id': socket_id})
+        with open(path, "r", encoding="utf-8") as f:
+            contents = f.read()
+            soup = BeautifulSoup(contents)
+            single_text = soup.get_text()
+            glossary_terms = generate_glossary_terms(single_text)
+        single_file = {
+            "text": single_text,
+            "glossary": glossary_terms
+        }
+    # upload text file
+    elif file_mimetype == "text/plain":
+        sio.emit('llm_message', {'message': f'Analyzing Text File "{file_name}"', 'socket_id': socket_id})
+        with open(path, "r", encoding="utf-8") as f:
+            contents = f.read()
+            single_text = contents
+            glossary_terms = generate_glossary_terms(single_text)
+        single_file = {
+            "text": single_text,
+            "glossary": glossary_terms
+        }
+    # upload image file
+    elif "image" in file_mimetype:
+        sio.emit('llm_message', {'message': f'Analyzing Image File "{file_name}"', 'socket_id': socket_id})
+        encoding = encode_image(path)
+        mime_type = mimetypes.guess_type(path)[0]
+        prompt_dict = [
+            {
+                "type": "text",
+                "text": "What is this image showing, be as detailed as possible"
+            },
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:{mime_type};base64,{encoding}",
+                    "detail": "auto"
                 }
-            else:
-                sio.emit('llm_message', {'message': f'File "{file_name}" cannot be processed', 'socket_id': socket_id})
-
-        # define a dictionary for a file
-        file_as_dict = {
-            "filename": file_name,
-            "mimetype": file_mimetype,
-            "filehash": file_hash,
-            "filepath": file_path,
-            "file_id": file_id,
-            "content": single_file
+            }
+        ]
+        single_text = image_to_openai(prompt_dict)
+        single_file = {
+            "image": single_text
         }
-        ### CACHE TO MINIMIZE AZURE API CALLS
-        if is_cached and USE_CACHE:
-            sio.emit('llm_message', {'message': f'Getting "{file_name}" from Cache', 'socket_id': socket_id})
-            print("USING CACHE")
-            cache_path = download_cache(file_hash)  # download cache file
-            txt = read_from_file(cache_path)  # read cache file
-            file_as_dict = text_to_dict(txt)  # file to dict
-        else:
-            sio.emit('llm_message', {'message': f'Saving file "{file_name}" to Cache', 'socket_id': socket_id})
-            print("NOT USING CACHE")
-            file_path = write_to_file(file_hash, json.dumps(file_as_dict, ensure_ascii=False, indent=2))
-            upload_cache_file(file_path, file_hash)
-
-        attachments.append(file_as_dict)
-        files_json = json.dumps(attachments, ensure_ascii=False, indent=2)
-
-        # debug
-        write_to_file(str(time.time()), files_json)
-        # delete temp folder
-        delete_temp_folder(file_hash)
-
-    return files_json
+    # upload video file
+    elif "video" in file_mimetype:
+        sio.emit('llm_message', {'message': f'Analyzing Video File "{file_name}"', 'socket_id': socket_id})
+
+        frame_path, audio_path, duration = extract_data_from_video(path, file_hash)
+        frames, frame_timestamps = sample_frames(get_all_frames_in_dir(frame_path), duration)
+
+        transcription = transcribe(audio_path, file_hash, analyzed_attachments, socket_id)
+        video_summary = process_segments(frames, transcription, duration, socket_id, frame_timestamps)
+        single_file = {
+            # videos without an audio stream have no transcription
+            "transcription": transcription["transcription"] if transcription else {"segments": []},
+            "video_summary": video_summary["video_summary"]
+        }
+    else:
+        sio.emit('llm_message', {'message': f'File "{file_name}" cannot be processed', 'socket_id': socket_id})
+
+    # define a dictionary for a file
+    file_as_dict = {
+        "filename": file_name,
+        "mimetype": file_mimetype,
+        "filehash": file_hash,
+        "filepath": file_path,
+        "file_id": file_id,
+        "content": single_file
+    }
+    sio.emit('llm_message', {'message': f'Saving file "{file_name}" to Cache', 'socket_id': socket_id})
+    processing_cache.put(file_hash, file_as_dict)
+
+    # delete temp folder
+    delete_temp_folder(file_hash)
+
+    return file_as_dict
+
+
+def needs_transcription(item):
+    """
+    Audio and video files are transcribed with Whisper and need the glossary terms of all other files
+    """
+    return "audio" in item["mimetype"] or "video" in item["mimetype"]
 
 
 def sort_attachments(item):
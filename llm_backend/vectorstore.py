@@ -1,26 +1,83 @@
+import concurrent.futures
+import hashlib
 import os
+import threading
 import uuid
 
 from qdrant_client import QdrantClient
-from qdrant_client.models import VectorParams, Distance, PointStruct, Filter, FieldCondition
-
-from app import app
-from azure import get_embeddings
+from qdrant_client.models import (
+    VectorParams, Distance, PointStruct, Filter, FieldCondition, SparseVectorParams, Modifier, Prefetch, FusionQuery,
+    Fusion, QueryRequest, PayloadSchemaType, MatchValue, MatchAny, FilterSelector, IsEmptyCondition, PayloadField,
+)
+
+from app import app, sio
+from components import component
+from azure import get_embeddings, deployment_limit, AZURE_DEPLOYMENT_EMBEDDING
+from embedding_cache import EmbeddingCache
 from preprocess_files import process_attachment
+from rwlock import ReadWriteLock
+from sparse import document_vector, query_vector
+from tokens import count_tokens
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+# Azure limits the amount of inputs and tokens per embeddings request
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 16))
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", 32000))
+EMBEDDING_MAX_WORKERS = int(os.getenv("EMBEDDING_MAX_WORKERS", 4))
+EMBEDDING_CACHE_MEMORY_SIZE = int(os.getenv("EMBEDDING_CACHE_MEMORY_SIZE", 2048))
+EMBEDDING_CACHE_DISK_SIZE = int(os.getenv("EMBEDDING_CACHE_DISK_SIZE", 100000))
+
+# name of the sparse lexical vector stored next to the unnamed dense vector
+SPARSE_VECTOR_NAME = "text-sparse"
+# amount of candidates of the dense and the sparse search that are fused into the result of a hybrid search
+HYBRID_PREFETCH_LIMIT = int(os.getenv("HYBRID_PREFETCH_LIMIT", 20))
+MIGRATION_PAGE_SIZE = 256
+# page size of filter-only lookups
+SCROLL_PAGE_SIZE = 1000
+# metadata keys used in filters, they get a payload index
+PAYLOAD_INDEXES = {
+    "metadata.case_id": PayloadSchemaType.INTEGER,
+    "metadata.file_id": PayloadSchemaType.INTEGER,
+    "metadata.inserttype": PayloadSchemaType.KEYWORD,
+    "metadata.filehash": PayloadSchemaType.KEYWORD,
+    "metadata.file_ids": PayloadSchemaType.INTEGER,
+    "metadata.case_ids": PayloadSchemaType.INTEGER,
+}
+# attachment chunks are stored once per content, their ids are derived from the filehash and the chunk text
+CHUNK_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "arcanum/attachment-chunk")
+# case fields that change without changing the content, they are not embedded and their changes only update the payload
+VOLATILE_CASE_FIELDS = ["status", "assignees", "priority", "draft", "createdAt", "updatedAt"]
+# attachment fields stored in the chunk metadata of the primary attachment
+ATTACHMENT_METADATA_FIELDS = ["filename", "filepath", "size", "mimetype"]
+ATTACHMENT_LOCK_STRIPES = 64
 
 
 class QdrantVectorstore:
     def __init__(self, colletion_name="main_collection"):
         """
         Initialize the QdrantVectorstore with a collection name and setup the Azure OpenAI embeddings client.
+        Reads on the Qdrant client run concurrently, writes are exclusive.
         
         Args:
             colletion_name (str): The name of the collection to use in Qdrant.
         """
+        self.lock = ReadWriteLock()
+        # attachments with the same content are inserted one after another
+        self.attachment_locks = [threading.Lock() for _ in range(ATTACHMENT_LOCK_STRIPES)]
         self.client = QdrantClient(path=os.path.join(app.root_path, "qdrant-data"))
+        # the store is embedded in the process (local mode), it has no payload indexes
+        self.local = True
         self.collection_name = colletion_name
         self.llm_embeddings = get_embeddings()
+        self.embedding_cache = EmbeddingCache(
+            os.path.join(app.root_path, "embedding-cache", "embeddings.sqlite"),
+            max_memory_entries=EMBEDDING_CACHE_MEMORY_SIZE,
+            max_disk_entries=EMBEDDING_CACHE_DISK_SIZE,
+        )
+        self.migrate_collection()
         self.setup_collection(1536)  # 1536 is the default vector size for text-embedding-ada-002 embeddings
+        self.setup_payload_indexes()
+        self.migrate_chunk_references()
 
     def __enter__(self):
         # Initialize or open resources
@@ -28,7 +85,15 @@ def __enter__(self):
 
     def __exit__(self, exc_type, exc_value, traceback):
         # Clean up or close resources
-        self.client.close()
+        self.close()
+
+    def close(self):
+        """
+        Close the Qdrant client after all running reads and writes are finished.
+        """
+        with self.lock.write():
+            self.client.close()
+        self.embedding_cache.close()
 
     def setup_collection(self, vector_size):
         """
@@ -37,15 +102,198 @@ def setup_collection(self, vector_size):
         Args:
             vector_size (int): The size of the vectors to store in the collection.
         """
-        if not self.client.collection_exists(self.collection_name):
-            self.client.create_collection(
-                collection_name=self.collection_name,
-                vectors_config=VectorParams(size=vector_size, distance=Distance.COSINE),
+        with self.lock.write():
+            if not self.client.collection_exists(self.collection_name):
+                self._create_hybrid_collection(self.collection_name, vector_size)
+
+    def setup_payload_indexes(self):
+        """
+        Create the payload indexes of the metadata keys used in filters if they do not exist yet.
+        The embedded (local) Qdrant does not support payload indexes, there is nothing to create.
+        """
+        if self.local:
+            return
+        with self.lock.write():
+            payload_schema = self.client.get_collection(self.collection_name).payload_schema or {}
+            for field_name, field_schema in PAYLOAD_INDEXES.items():
+                if field_name not in payload_schema:
+                    self.client.create_payload_index(
+                        collection_name=self.collection_name, field_name=field_name, field_schema=field_schema
+                    )
+
+    def migrate_chunk_references(self):
+        """
+        Add the owners to attachment chunks stored before the chunks were shared by content.
+        Chunks of the same content stored for several attachments are merged into the chunks of the first attachment.
+        The attachment chunks are read in one paginated pass and grouped by content, every content is then updated
+        with one delete and one payload update by point ids.
+        """
+        legacy_filter = Filter(must=[
+            FieldCondition(key="metadata.inserttype", match=MatchValue(value="attachment-chunk")),
+            IsEmptyCondition(is_empty=PayloadField(key="metadata.owners")),
+        ])
+        with self.lock.write():
+            if not self._exists(legacy_filter):
+                return
+
+            # filehash -> owners by file id, point ids by file id and whether the content has chunks without owners
+            contents = {}
+            chunk_filter = Filter(must=[
+                FieldCondition(key="metadata.inserttype", match=MatchValue(value="attachment-chunk"))
+            ])
+            offset = None
+            while True:
+                points, offset = self.client.scroll(
+                    collection_name=self.collection_name, scroll_filter=chunk_filter, limit=SCROLL_PAGE_SIZE,
+                    offset=offset, with_payload=["metadata"], with_vectors=False,
+                )
+                for point in points:
+                    metadata = point.payload["metadata"]
+                    content = contents.setdefault(metadata["filehash"], {"owners": {}, "point_ids": {}, "legacy": False})
+                    if metadata.get("owners"):
+                        # chunks migrated by an interrupted run keep their owners
+                        for owner in metadata["owners"]:
+                            content["owners"].setdefault(owner["file_id"], owner)
+                    else:
+                        content["legacy"] = True
+                        content["owners"].setdefault(
+                            metadata["file_id"], self._owner(metadata, metadata.get("case_ids") or [])
+                        )
+                    content["point_ids"].setdefault(metadata["file_id"], []).append(point.id)
+                if offset is None:
+                    break
+
+            migrated = 0
+            for content in contents.values():
+                if not content["legacy"]:
+                    continue
+                owners = list(content["owners"].values())
+                primary_file_id = owners[0]["file_id"]
+                duplicate_ids = [
+                    point_id for file_id, point_ids in content["point_ids"].items() if file_id != primary_file_id
+                    for point_id in point_ids
+                ]
+                if duplicate_ids:
+                    self.client.delete(collection_name=self.collection_name, points_selector=duplicate_ids)
+                self.client.set_payload(
+                    collection_name=self.collection_name,
+                    payload=self._owners_payload(owners),
+                    key="metadata",
+                    points=content["point_ids"][primary_file_id],
+                )
+                migrated += 1
+        print(f"Added owners to the chunks of {migrated} attachments.")
+
+    @staticmethod
+    def _owner(attachment, case_ids):
+        """
+        metadata of one attachment that owns a content, attachment dictionaries and chunk metadata are both accepted
+        """
+        return {
+            "file_id": attachment["id"] if "id" in attachment else attachment["file_id"],
+            **{key: attachment.get(key) for key in ATTACHMENT_METADATA_FIELDS},
+            "case_ids": list(case_ids),
+        }
+
+    @staticmethod
+    def _owners_payload(owners):
+        """
+        chunk metadata derived from the owners of a content
+        the first owner is the primary attachment used for citations, case_ids contains the cases of all owners
+        """
+        case_ids = []
+        for owner in owners:
+            case_ids.extend(case_id for case_id in owner["case_ids"] if case_id not in case_ids)
+        return {
+            "file_id": owners[0]["file_id"],
+            **{key: owners[0][key] for key in ATTACHMENT_METADATA_FIELDS},
+            "owners": owners,
+            "file_ids": [owner["file_id"] for owner in owners],
+            "case_ids": case_ids,
+        }
+
+    @staticmethod
+    def _content_conditions(filehash):
+        return [
+            FieldCondition(key="metadata.inserttype", match=MatchValue(value="attachment-chunk")),
+            FieldCondition(key="metadata.filehash", match=MatchValue(value=filehash)),
+        ]
+
+    @staticmethod
+    def chunk_point_id(filehash, chunk):
+        chunk_hash = hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+        return str(uuid.uuid5(CHUNK_ID_NAMESPACE, f"{filehash}:{chunk_hash}"))
+
+    def _create_hybrid_collection(self, collection_name, vector_size):
+        self.client.create_collection(
+            collection_name=collection_name,
+            vectors_config=VectorParams(size=vector_size, distance=Distance.COSINE),
+            sparse_vectors_config={SPARSE_VECTOR_NAME: SparseVectorParams(modifier=Modifier.IDF)},
+        )
+
+    def migrate_collection(self):
+        """
+        Add the sparse vectors to a collection that was created with dense vectors only.
+        The points are copied into a migration collection with their sparse vectors, the collection is recreated and
+        the points are copied back. An interrupted migration is continued on the next start.
+        """
+        migration_name = f"{self.collection_name}-migration"
+        with self.lock.write():
+            if self.client.collection_exists(self.collection_name):
+                collection_info = self.client.get_collection(self.collection_name)
+                if SPARSE_VECTOR_NAME not in (collection_info.config.params.sparse_vectors or {}):
+                    print(f"Adding sparse vectors to {self.collection_name}...")
+                    # an interrupted copy is started again, the original collection is still complete
+                    if self.client.collection_exists(migration_name):
+                        self.client.delete_collection(migration_name)
+                    self._create_hybrid_collection(migration_name, collection_info.config.params.vectors.size)
+                    self._copy_points(self.collection_name, migration_name)
+                    self.client.delete_collection(self.collection_name)
+
+            if self.client.collection_exists(migration_name):
+                if not self.client.collection_exists(self.collection_name):
+                    vector_size = self.client.get_collection(migration_name).config.params.vectors.size
+                    self._create_hybrid_collection(self.collection_name, vector_size)
+                self._copy_points(migration_name, self.collection_name)
+                self.client.delete_collection(migration_name)
+                print(f"Sparse vectors added to {self.collection_name}.")
+
+    def _copy_points(self, source_name, target_name):
+        """
+        Copy all points between collections page by page and compute their sparse vectors from the text.
+        """
+        offset = None
+        while True:
+            points, offset = self.client.scroll(
+                collection_name=source_name, limit=MIGRATION_PAGE_SIZE, offset=offset,
+                with_payload=True, with_vectors=True,
             )
+            if points:
+                self.client.upsert(
+                    collection_name=target_name,
+                    points=[
+                        PointStruct(
+                            id=point.id,
+                            vector=self._point_vectors(
+                                point.vector[""] if isinstance(point.vector, dict) else point.vector,
+                                point.payload["text"],
+                            ),
+                            payload=point.payload,
+                        )
+                        for point in points
+                    ],
+                )
+            if offset is None:
+                break
+
+    @staticmethod
+    def _point_vectors(embedding, text):
+        return {"": embedding, SPARSE_VECTOR_NAME: document_vector(text)}
 
     def create_embedding(self, string_to_embed):
         """
         Create an embedding for a given string using Azure OpenAI embeddings.
+        Embeddings of already known strings are taken from the embedding cache.
         
         Args:
             string_to_embed (str): The string to create an embedding for.
@@ -53,84 +301,315 @@ def create_embedding(self, string_to_embed):
         Returns:
             list: The embedding vector for the input string.
         """
-        response = self.llm_embeddings.embeddings.create(input=string_to_embed, model="text-embedding-ada-002")
+        embedding = self.embedding_cache.get(EMBEDDING_MODEL, string_to_embed)
+        if embedding is not None:
+            return embedding
+
+        response = self.llm_embeddings.embeddings.create(input=string_to_embed, model=EMBEDDING_MODEL)
         embedding = response.data[0].embedding
+        self.embedding_cache.put(EMBEDDING_MODEL, string_to_embed, embedding)
 
         return embedding
 
-    def insert_embedding(self, embedding, text, id=None, metadata={}):
+    def batch_texts(self, texts):
+        """
+        Split texts into batches that respect the maximum amount of inputs and tokens per embeddings request.
+
+        Args:
+            texts (list): The strings to split into batches.
+
+        Returns:
+            list: A list of batches, each batch is a list of indices into texts.
+        """
+        batches = []
+        batch = []
+        batch_tokens = 0
+        for index, text in enumerate(texts):
+            tokens = count_tokens(text, EMBEDDING_MODEL)
+            if batch and (len(batch) >= EMBEDDING_BATCH_SIZE or batch_tokens + tokens > EMBEDDING_BATCH_MAX_TOKENS):
+                batches.append(batch)
+                batch = []
+                batch_tokens = 0
+            batch.append(index)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def create_embeddings(self, strings_to_embed, on_progress=None):
+        """
+        Create embeddings for multiple strings using batched and concurrent Azure OpenAI embeddings requests.
+        Only strings that are not in the embedding cache are sent to Azure.
+
+        Args:
+            strings_to_embed (list): The strings to create embeddings for.
+            on_progress (callable): Optional callback receiving (embedded, total) after each finished batch.
+
+        Returns:
+            list: The embedding vectors in the same order as the input strings.
+        """
+        embeddings = [self.embedding_cache.get(EMBEDDING_MODEL, string) for string in strings_to_embed]
+
+        # embed every missing string only once, even if it occurs multiple times
+        missing_positions = {}
+        for position, embedding in enumerate(embeddings):
+            if embedding is None:
+                missing_positions.setdefault(strings_to_embed[position], []).append(position)
+        missing_strings = list(missing_positions)
+        batches = self.batch_texts(missing_strings)
+
+        def embed_batch(batch):
+            with deployment_limit(AZURE_DEPLOYMENT_EMBEDDING):
+                response = self.llm_embeddings.embeddings.create(
+                    input=[missing_strings[index] for index in batch], model=EMBEDDING_MODEL
+                )
+            # the response data is not guaranteed to be in the order of the input
+            return batch, sorted(response.data, key=lambda item: item.index)
+
+        embedded = len(strings_to_embed) - sum(len(positions) for positions in missing_positions.values())
+        with concurrent.futures.ThreadPoolExecutor(max_workers=EMBEDDING_MAX_WORKERS) as executor:
+            futures = [executor.submit(embed_batch, batch) for batch in batches]
+            for future in concurrent.futures.as_completed(futures):
+                batch, data = future.result()
+                # one cache transaction per embeddings request
+                self.embedding_cache.put_many(
+                    EMBEDDING_MODEL, [(missing_strings[index], item.embedding) for index, item in zip(batch, data)]
+                )
+                for index, item in zip(batch, data):
+                    string = missing_strings[index]
+                    for position in missing_positions[string]:
+                        embeddings[position] = item.embedding
+                    embedded += len(missing_positions[string])
+                if on_progress:
+                    on_progress(embedded, len(strings_to_embed))
+
+        print(f"Embedding cache: {self.embedding_cache.stats()}")
+        return embeddings
+
+    def insert_embedding(self, embedding, text, id=None, metadata={}, sparse_text=None):
+        """
+        Insert an embedding into the Qdrant collection.
+
+        Args:
+            embedding (list): The embedding vector.
+            text (str): The text stored in the payload.
+            id: The point id, a random id if not given.
+            metadata (dict): The metadata dictionary.
+            sparse_text (str): The text of the sparse vector, defaults to the text.
+        """
         vector_size = len(embedding)
         self.setup_collection(vector_size)
 
         if not id:
             id = str(uuid.uuid4())
 
-        self.client.upsert(
-            collection_name=self.collection_name,
-            points=[
-                PointStruct(
-                    id=id,
-                    vector=embedding,
-                    payload={
-                        "text": text,
-                        "metadata": {**metadata},
-                    }
-                )
-            ]
-        )
+        with self.lock.write():
+            self.client.upsert(
+                collection_name=self.collection_name,
+                points=[
+                    PointStruct(
+                        id=id,
+                        vector=self._point_vectors(embedding, text if sparse_text is None else sparse_text),
+                        payload={
+                            "text": text,
+                            "metadata": {**metadata},
+                        }
+                    )
+                ]
+            )
+
+    def insert_embeddings(self, embeddings, texts, metadatas, ids=None):
+        """
+        Insert multiple embeddings into the Qdrant collection with a single bulk upsert.
+
+        Args:
+            embeddings (list): The embedding vectors to insert.
+            texts (list): The text of each embedding.
+            metadatas (list): The metadata dictionary of each embedding.
+            ids (list): The point id of each embedding, random ids if not given.
+        """
+        if not embeddings:
+            return
+        self.setup_collection(len(embeddings[0]))
+        if ids is None:
+            ids = [str(uuid.uuid4()) for _ in embeddings]
+
+        with self.lock.write():
+            self.client.upsert(
+                collection_name=self.collection_name,
+                points=[
+                    PointStruct(
+                        id=id,
+                        vector=self._point_vectors(embedding, text),
+                        payload={
+                            "text": text,
+                            "metadata": {**metadata},
+                        }
+                    )
+                    for id, embedding, text, metadata in zip(ids, embeddings, texts, metadatas)
+                ]
+            )
 
     def insert_case(self, case, id=None):
         """
         Insert a case into the Qdrant collection.
+        The embedding is created from the case without the VOLATILE_CASE_FIELDS, its fingerprint is stored in the metadata.
+        If the fingerprint of a stored case did not change, only its payload is updated.
         
         Args:
             case (dict): The case dictionary to insert.
         """
         case_string = self.case_to_string(case)
-
-        # Generate Embedding
-        case_embedding = self.llm_embeddings.embeddings.create(input=case_string, model="text-embedding-ada-002")
-        case_embedding = case_embedding.data[0].embedding
+        embedding_string = self.case_to_string(self.case_embedding_fields(case))
+        fingerprint = hashlib.sha256(embedding_string.encode("utf-8")).hexdigest()
 
         metadata = {"case_id": id,
-                    "inserttype": "case", }
+                    "inserttype": "case",
+                    "fingerprint": fingerprint, }
+
+        stored = self.get_entry(id) if id is not None else None
+        if stored and stored.payload["metadata"].get("fingerprint") == fingerprint:
+            if stored.payload["text"] != case_string or stored.payload["metadata"] != metadata:
+                with self.lock.write():
+                    self.client.set_payload(
+                        collection_name=self.collection_name,
+                        payload={"text": case_string, "metadata": metadata},
+                        points=[id],
+                    )
+                print("Case payload updated without re-embedding.")
+            return
+
+        # Generate Embedding
+        case_embedding = self.create_embedding(embedding_string)
 
-        self.insert_embedding(embedding=case_embedding, id=id, text=case_string, metadata=metadata)
+        # the dense and the sparse vector only depend on the fingerprinted fields, so payload updates keep them valid
+        self.insert_embedding(embedding=case_embedding, id=id, text=case_string, metadata=metadata,
+                              sparse_text=embedding_string)
         print("Case added to Qdrant collection.")
 
-    def insert_attachment(self, attachment):
+    @staticmethod
+    def case_embedding_fields(case):
+        """
+        The fields of a case that are embedded and fingerprinted.
+        Glossary entries are reduced to their terms, the stored entries also carry usage counts and timestamps.
+
+        Args:
+            case (dict): The case dictionary.
+
+        Returns:
+            dict: The case without its volatile fields.
+        """
+        fields = {key: value for key, value in case.items() if key not in VOLATILE_CASE_FIELDS}
+        if "glossary" in fields:
+            fields["glossary"] = [
+                entry["term"] if isinstance(entry, dict) else entry for entry in fields["glossary"] or []
+            ]
+        return fields
+
+    def get_entry(self, point_id):
+        """
+        Get an entry by its id without its vectors.
+
+        Args:
+            point_id: The id of the entry.
+
+        Returns:
+            Record: The entry or None if it does not exist.
+        """
+        with self.lock.read():
+            records = self.client.retrieve(
+                collection_name=self.collection_name, ids=[point_id], with_payload=True, with_vectors=False
+            )
+        return records[0] if records else None
+
+    def insert_attachment(self, attachment, case_id=None, socket_id=None):
         """
         Insert an attachment into the Qdrant collection.
+        The chunks are stored once per content (filehash), further attachments and cases with the same content are only
+        added to the owner lists of the stored chunks. New content is embedded in batches and written with one bulk upsert.
         
         Args:
             attachment (dict): The attachment dictionary to insert.
+            case_id (int): Optional id of the case the attachment belongs to.
+            socket_id (str): Optional socket id to send progress messages to.
         """
-        if self.search_by_metadata("file_id", attachment["id"]):
-            return
+        filehash = attachment["filehash"]
+        with self.attachment_locks[int(hashlib.sha256(filehash.encode("utf-8")).hexdigest(), 16) % ATTACHMENT_LOCK_STRIPES]:
+            if self.add_attachment_references(attachment, case_id):
+                print(f"Attachment content already stored, updated references of file {attachment['id']}.")
+                return
+            self._insert_attachment_chunks(attachment, case_id, socket_id)
+
+    def add_attachment_references(self, attachment, case_id=None):
+        """
+        Add an attachment and a case to the owners of the stored chunks of a content.
+        Changed metadata of the attachment is updated in the same operation. An attachment that is not an owner of the
+        content yet is removed from the chunks of its previous content first.
+
+        Args:
+            attachment (dict): The attachment dictionary.
+            case_id (int): Optional id of the case.
+
+        Returns:
+            bool: True if the content is stored, False if it has to be inserted.
+        """
+        file_id = attachment["id"]
+        content_filter = Filter(must=self._content_conditions(attachment["filehash"]))
+        with self.lock.write():
+            metadata = None
+            if self._exists(content_filter):
+                points, _ = self.client.scroll(
+                    collection_name=self.collection_name, scroll_filter=content_filter, limit=1,
+                    with_payload=["metadata"], with_vectors=False,
+                )
+                metadata = points[0].payload["metadata"]
+            if metadata is None or file_id not in metadata["file_ids"]:
+                # the attachment is new or its content changed, only then a previous content has to be searched
+                self._remove_chunk_references([], [file_id], keep_filehash=attachment["filehash"])
+            if metadata is None:
+                return False
+            owners = [dict(owner) for owner in metadata["owners"]]
+            owner = next((owner for owner in owners if owner["file_id"] == file_id), None)
+            if owner is None:
+                owner = self._owner(attachment, [])
+                owners.append(owner)
+            owner.update({key: attachment[key] for key in ATTACHMENT_METADATA_FIELDS if key in attachment})
+            if case_id is not None and case_id not in owner["case_ids"]:
+                owner["case_ids"] = owner["case_ids"] + [case_id]
+            payload = self._owners_payload(owners)
+            if any(metadata.get(key) != value for key, value in payload.items()):
+                self.client.set_payload(
+                    collection_name=self.collection_name,
+                    payload=payload,
+                    key="metadata",
+                    points=content_filter,
+                )
+        return True
 
-        file_dict = process_attachment(attachment)
+    def _insert_attachment_chunks(self, attachment, case_id, socket_id):
+        file_dict = process_attachment(attachment, socket_id)
 
         metadata = {
-            "file_id": attachment["id"],
-            "filename": attachment["filename"],
-            "filepath": attachment["filepath"],
-            "size": attachment["size"],
+            # the primary file id is used for citations, the content is owned by all owners
+            **self._owners_payload([self._owner(attachment, [case_id] if case_id is not None else [])]),
             "filehash": attachment["filehash"],
-            "mimetype": attachment["mimetype"],
             "inserttype": "attachment-chunk"
         }
 
-        for chunk_index, chunk in enumerate(file_dict["chunks"]):
-            attachment_string = chunk
+        def report_progress(embedded, total):
+            if socket_id:
+                sio.emit('llm_message', {'message': f'Embedding "{attachment["filename"]}": {embedded}/{total} chunks',
+                                         'socket_id': socket_id})
 
-            response = self.llm_embeddings.embeddings.create(input=attachment_string, model="text-embedding-ada-002")
-            attachment_embedding = response.data[0].embedding
+        chunks = file_dict["chunks"]
+        embeddings = self.create_embeddings(chunks, on_progress=report_progress)
+        metadatas = [{**metadata, "chunk_number": chunk_index + 1} for chunk_index in range(len(chunks))]
 
-            metadata["chunk_number"] = chunk_index + 1
+        ids = [self.chunk_point_id(attachment["filehash"], chunk) for chunk in chunks]
 
-            self.insert_embedding(embedding=attachment_embedding, text=attachment_string, metadata=metadata)
+        self.insert_embeddings(embeddings=embeddings, texts=chunks, metadatas=metadatas, ids=ids)
 
-        print("Attachment added to Qdrant collection.")
+        print(f"Attachment added to Qdrant collection ({len(chunks)} chunks).")
 
     def search_vectors(self, query_vector, limit, filter_condition):
         """
@@ -145,14 +624,48 @@ def search_vectors(self, query_vector, limit, filter_condition):
             list: The search results.
         """
         query_filter = Filter(must=[filter_condition]) if filter_condition else None
-        hits = self.client.search(
-            collection_name=self.collection_name,
-            query_vector=query_vector,
-            query_filter=query_filter,
-            limit=limit
-        )
+        with self.lock.read():
+            hits = self.client.search(
+                collection_name=self.collection_name,
+                query_vector=query_vector,
+                query_filter=query_filter,
+                limit=limit
+            )
         return hits
 
+    def search_queries(self, queries, limits, filter_condition=None):
+        """
+        Hybrid search for multiple queries with one embeddings call and one batch query.
+        The dense and the sparse candidates of every query are fused with reciprocal rank fusion.
+
+        Args:
+            queries (list): The query texts.
+            limits (list): The maximum number of results per query.
+            filter_condition (FieldCondition): The filter condition to apply to all searches.
+
+        Returns:
+            list: One list of search results per query.
+        """
+        if not queries:
+            return []
+        query_embeddings = self.create_embeddings(queries)
+        query_filter = Filter(must=[filter_condition]) if filter_condition else None
+        requests = []
+        for query, embedding, limit in zip(queries, query_embeddings, limits):
+            prefetch_limit = max(limit, HYBRID_PREFETCH_LIMIT)
+            prefetch = [Prefetch(query=embedding, filter=query_filter, limit=prefetch_limit)]
+            sparse_query = query_vector(query)
+            if sparse_query.indices:
+                prefetch.append(
+                    Prefetch(query=sparse_query, using=SPARSE_VECTOR_NAME, filter=query_filter, limit=prefetch_limit)
+                )
+            requests.append(
+                QueryRequest(prefetch=prefetch, query=FusionQuery(fusion=Fusion.RRF), limit=limit, with_payload=True)
+            )
+        with self.lock.read():
+            responses = self.client.query_batch_points(collection_name=self.collection_name, requests=requests)
+        return [response.points for response in responses]
+
     def search_similar_cases(self, case, limit=5, filter_condition=None):
         case_string = self.case_to_string(case)
         case_embedding = self.create_embedding(case_string)
@@ -164,27 +677,79 @@ def search_from_query(self, query, limit=5, filter_condition=None):
 
         return self.search_vectors(embedding, limit, filter_condition)
 
-    def search_by_metadata(self, key, value, limit=10000):
+    @staticmethod
+    def metadata_filter(key, value):
+        return Filter(must=[FieldCondition(key=f"metadata.{key}", match=MatchValue(value=value))])
+
+    def find_by_metadata(self, key, value, limit=None):
         """
-        Search for an entry in the collection with a specific key-value pair in the metadata.
-        
+        Find all entries with a specific key-value pair in the metadata.
+        Only the payload index is used, no vectors are scored or returned.
+
         Args:
-            key (str): The metadata key to search for.
-            value (str): The value of the metadata key to search for.
-            limit (int): The maximum number of results to return.
-        
+            key (str): The metadata key to filter by.
+            value: The value of the metadata key.
+            limit (int): The maximum number of entries to return, None for all.
+
         Returns:
-            list: The search results.
+            list: The matching records with their payload.
         """
-        filter_condition = FieldCondition(
-            key=f"metadata.{key}",
-            match={"value": value}
-        )
-        # Get the vector size from the collection configuration
-        collection_info = self.client.get_collection(self.collection_name)
-        vector_size = collection_info.config.params.vectors.size
-        default_query_vector = [0.0] * vector_size
-        return self.search_vectors(query_vector=default_query_vector, limit=limit, filter_condition=filter_condition)
+        records = []
+        offset = None
+        while limit is None or len(records) < limit:
+            page_size = SCROLL_PAGE_SIZE if limit is None else min(SCROLL_PAGE_SIZE, limit - len(records))
+            with self.lock.read():
+                points, offset = self.client.scroll(
+                    collection_name=self.collection_name,
+                    scroll_filter=self.metadata_filter(key, value),
+                    limit=page_size,
+                    offset=offset,
+                    with_payload=True,
+                    with_vectors=False,
+                )
+            records.extend(points)
+            if offset is None:
+                break
+        return records
+
+    def count_by_metadata(self, key, value):
+        """
+        Count the entries with a specific key-value pair in the metadata.
+
+        Args:
+            key (str): The metadata key to filter by.
+            value: The value of the metadata key.
+
+        Returns:
+            int: The amount of matching entries.
+        """
+        with self.lock.read():
+            return self.client.count(
+                collection_name=self.collection_name, count_filter=self.metadata_filter(key, value), exact=True
+            ).count
+
+    def exists_by_metadata(self, key, value):
+        """
+        Check if an entry with a specific key-value pair in the metadata exists.
+
+        Args:
+            key (str): The metadata key to filter by.
+            value: The value of the metadata key.
+
+        Returns:
+            bool: True if at least one entry matches.
+        """
+        with self.lock.read():
+            return self._exists(self.metadata_filter(key, value))
+
+    def _exists(self, query_filter):
+        """
+        Check if an entry matches the filter, must be called with the lock.
+        Counting is faster than a filtered scroll in the embedded store, which sorts all point ids for every scroll.
+        """
+        return self.client.count(
+            collection_name=self.collection_name, count_filter=query_filter, exact=True
+        ).count > 0
 
     def case_to_string(self, case_dict):
         """
@@ -215,33 +780,184 @@ def case_to_string(self, case_dict):
 
         return case_string
 
-    def show_all_entries(self):
-        return self.client.scroll(collection_name=self.collection_name, limit=10000, scroll_filter=None)[0]
+    def iter_entry_pages(self, offset=None, limit=None, fields=None, with_vectors=False, page_size=SCROLL_PAGE_SIZE):
+        """
+        Iterate over the entries of the collection page by page, only one page is held in memory.
+
+        Args:
+            offset: The id of the first entry, None to start at the beginning.
+            limit (int): The maximum number of entries, None for all remaining entries.
+            fields (list): The payload keys to return, None for the whole payload, an empty list for no payload.
+            with_vectors (bool): Whether the vectors are returned.
+            page_size (int): The number of entries per page.
+
+        Yields:
+            tuple: The records of a page and the offset of the next page, None after the last page.
+        """
+        with_payload = True if fields is None else (fields or False)
+        remaining = limit
+        while True:
+            size = page_size if remaining is None else min(page_size, remaining)
+            with self.lock.read():
+                records, offset = self.client.scroll(
+                    collection_name=self.collection_name,
+                    limit=size,
+                    offset=offset,
+                    with_payload=with_payload,
+                    with_vectors=with_vectors,
+                )
+            yield records, offset
+            if remaining is not None:
+                remaining -= len(records)
+            if offset is None or remaining == 0:
+                return
 
     def show_all_collections(self):
-        return self.client.list_collections()
+        with self.lock.read():
+            return self.client.get_collections()
 
     def delete_entry(self, point_id):
-        self.client.delete(collection_name=self.collection_name, points_selector=[point_id])
+        with self.lock.write():
+            self.client.delete(collection_name=self.collection_name, points_selector=[point_id])
 
     def delete_entries(self, point_ids):
-        self.client.delete(collection_name=self.collection_name, points_selector=point_ids)
+        with self.lock.write():
+            self.client.delete(collection_name=self.collection_name, points_selector=point_ids)
+
+    def delete_by_metadata(self, case_ids=(), file_ids=()):
+        """
+        Delete all entries of the given cases and attachments.
+        The case entries are deleted with one filter delete. The ids are removed from the owner lists of the shared
+        attachment chunks, chunks without any remaining attachment are deleted with one filter delete per content.
+
+        Args:
+            case_ids (list): The case ids whose entries are deleted.
+            file_ids (list): The attachment ids whose chunks are deleted.
+
+        Returns:
+            dict: The amount of entries removed per id, {"case_ids": {id: count}, "file_ids": {id: count}}.
+        """
+        case_ids, file_ids = list(case_ids), list(file_ids)
+        deleted = {"case_ids": {}, "file_ids": {}}
+        with self.lock.write():
+            for case_id in case_ids:
+                deleted["case_ids"][case_id] = self.client.count(
+                    collection_name=self.collection_name, count_filter=self.metadata_filter("case_id", case_id),
+                    exact=True,
+                ).count
+            for file_id in file_ids:
+                deleted["file_ids"][file_id] = self.client.count(
+                    collection_name=self.collection_name, count_filter=self.metadata_filter("file_ids", file_id),
+                    exact=True,
+                ).count
+
+            if case_ids:
+                self.client.delete(
+                    collection_name=self.collection_name,
+                    points_selector=FilterSelector(filter=Filter(must=[
+                        FieldCondition(key="metadata.case_id", match=MatchAny(any=case_ids))
+                    ])),
+                )
+            self._remove_chunk_references(case_ids, file_ids)
+        return deleted
+
+    def _remove_chunk_references(self, case_ids, file_ids, keep_filehash=None):
+        """
+        Remove case and file ids from the owner lists of the attachment chunks, must be called with the write lock.
+        All chunks of a content share their owner lists, so every content is updated with one operation.
+        The content with keep_filehash is not changed.
+        """
+        should = []
+        if file_ids:
+            should.append(FieldCondition(key="metadata.file_ids", match=MatchAny(any=file_ids)))
+        if case_ids:
+            should.append(FieldCondition(key="metadata.case_ids", match=MatchAny(any=case_ids)))
+        if not should:
+            return
+
+        updated_filehashes = [keep_filehash] if keep_filehash else []
+        while True:
+            must_not = [FieldCondition(key="metadata.filehash", match=MatchAny(any=updated_filehashes))]
+            points, _ = self.client.scroll(
+                collection_name=self.collection_name,
+                scroll_filter=Filter(should=should, must_not=must_not if updated_filehashes else None),
+                limit=1, with_payload=True, with_vectors=False,
+            )
+            if not points:
+                break
+            metadata = points[0].payload["metadata"]
+            content_filter = Filter(must=self._content_conditions(metadata["filehash"]))
+            # the metadata of the primary attachment and the cases are derived from the remaining owners
+            remaining_owners = [
+                {**owner, "case_ids": [id for id in owner["case_ids"] if id not in case_ids]}
+                for owner in metadata["owners"] if owner["file_id"] not in file_ids
+            ]
+            if remaining_owners:
+                self.client.set_payload(
+                    collection_name=self.collection_name,
+                    payload=self._owners_payload(remaining_owners),
+                    key="metadata",
+                    points=content_filter,
+                )
+            else:
+                self.client.delete(
+                    collection_name=self.collection_name,
+                    points_selector=FilterSelector(filter=content_filter),
+                )
+            updated_filehashes.append(metadata["filehash"])
 
     def delete_all_entries_in_collection(self):
-        entries = self.show_all_entries()
-        point_ids = [entry.id for entry in entries]
-        self.delete_entries(point_ids)
+        """
+        Delete all entries with one filter delete, the collection and its configuration are kept.
+        """
+        with self.lock.write():
+            self.client.delete(
+                collection_name=self.collection_name, points_selector=FilterSelector(filter=Filter())
+            )
+
+
+_vectorstore = None
+_vectorstore_lock = threading.Lock()
+
+
+@component("vectorstore")
+def get_vectorstore():
+    """
+    Get the process wide vectorstore. The embedded Qdrant store is opened once and shared by all requests.
+
+    Returns:
+        QdrantVectorstore: The shared vectorstore.
+    """
+    global _vectorstore
+    with _vectorstore_lock:
+        if _vectorstore is None:
+            _vectorstore = QdrantVectorstore()
+        return _vectorstore
+
+
+def close_vectorstore():
+    """
+    Close the shared vectorstore, used as shutdown hook.
+    """
+    global _vectorstore
+    with _vectorstore_lock:
+        if _vectorstore is not None:
+            _vectorstore.close()
+            _vectorstore = None
+            print("Vectorstore closed.")
 
 
 def vector_db_save_cases(request, vectorstore):
     case = request.get_json(force=True)
+    # optional socket id to report the embedding progress, it is not part of the case
+    socket_id = case.pop("socket_id", None)
     attachments = case["attachments"]
     case["attachments"] = [attachment["id"] for attachment in attachments]
 
     vectorstore.insert_case(case, id=case["id"])
 
     for attachment in attachments:
-        vectorstore.insert_attachment(attachment)
+        vectorstore.insert_attachment(attachment, case_id=case["id"], socket_id=socket_id)
 
     return "Case and Attachments Saved Successfully", 200
 
@@ -250,29 +966,24 @@ def delete_entries_from_vector_db(request, vectorstore):
 
     returnString = ""
 
-    if request_json_str.get("caseId"):
-        case_id = request_json_str["caseId"]
-        entry = vectorstore.search_by_metadata("case_id", case_id, limit=10000)
-        if entry:
-            vectorstore.delete_entry(entry[0].id)
+    if not request_json_str.get("attachmentIds") and not request_json_str.get("caseId"):
+        return "No caseId or attachmentIds provided.", 400
+
+    case_id = request_json_str.get("caseId")
+    attachment_ids = request_json_str.get("attachmentIds") or []
+    deleted = vectorstore.delete_by_metadata(case_ids=[case_id] if case_id else [], file_ids=attachment_ids)
+    print(f"Deleted entries: {deleted}")
+
+    if case_id:
+        if deleted["case_ids"][case_id]:
             returnString += f"Case:{case_id} DELETED. "
         else:
             returnString += f"Case:{case_id} NOT FOUND. "
 
-    if request_json_str.get("attachmentIds"):
-        attachment_ids = request_json_str["attachmentIds"]
-        for attachment_id in attachment_ids:
-            entries = vectorstore.search_by_metadata("file_id", attachment_id)
-            print(entries)
-            print(type(entries))
-            if entries:
-                for entry in entries:
-                    vectorstore.delete_entry(entry.id)
-                returnString += f"Attachment:{attachment_id} DELETED. "
-            else:
-                returnString += f"Attachment:{attachment_id} NOT FOUND. "
-
-    if not request_json_str.get("attachmentIds") and not request_json_str.get("caseId"):
-        return "No caseId or attachmentIds provided.", 400
+    for attachment_id in attachment_ids:
+        if deleted["file_ids"][attachment_id]:
+            returnString += f"Attachment:{attachment_id} DELETED. "
+        else:
+            returnString += f"Attachment:{attachment_id} NOT FOUND. "
 
     return returnString, 200
\ No newline at end of file
@@ -1,15 +1,29 @@
+import concurrent.futures
 import math
 import os
 import subprocess
 
-import cv2
 from flask import abort
+from PIL import Image
 
 from app import app, sio
-from image import encode_image, image_to_openai
+from audio import probe_media
+from image import encode_image, image_to_openai, video_openai
 from app import temp_folder
 
 split_secs = 100
+# "parallel" summarizes all frame groups concurrently and merges them, "sequential" passes the summary of all previous groups to the next group
+VIDEO_SUMMARY_MODE = os.getenv("VIDEO_SUMMARY_MODE", "parallel")
+VIDEO_MAX_WORKERS = int(os.getenv("VIDEO_MAX_WORKERS", 4))
+# "fixed" sends every sampled frame, "adaptive" samples denser and drops near-duplicate frames by their perceptual hash
+VIDEO_FRAME_SAMPLING = os.getenv("VIDEO_FRAME_SAMPLING", "adaptive")
+# seconds between two sampled frames in adaptive mode, before the deduplication
+VIDEO_ADAPTIVE_SAMPLE_SECONDS = int(os.getenv("VIDEO_ADAPTIVE_SAMPLE_SECONDS", 4))
+# frames whose hashes differ in at most this many of the 64 bits count as duplicates
+VIDEO_FRAME_SIMILARITY = int(os.getenv("VIDEO_FRAME_SIMILARITY", 6))
+# maximum amount of frames per minute of video that are sent to the vision model in adaptive mode,
+# in total adaptive mode never sends more frames than fixed mode
+VIDEO_FRAMES_PER_MINUTE = int(os.getenv("VIDEO_FRAMES_PER_MINUTE", 5))
 
 """
     OpenAI has a limit of 50 pictures each request. If we would get 50 frames of a 10 minute video that would be around 
@@ -59,9 +73,11 @@ def cut_video_segments(input_file, filehash, segment_duration=split_secs):
 
 def extract_data_from_video(video_path, filehash):
     """
+    Extracts the scaled frames and the Whisper-ready mp3 audio with a single ffmpeg pass.
+    The duration is read from the metadata with ffprobe.
     :param video_path: path to the video
     :param filehash: hash of the video
-    :return: path to frames, path to the extracted audio and the duration of the video
+    :return: path to frames, path to the extracted audio (None if the video has no audio) and the duration of the video
     """
     # define ouput
     single_video = video_path
@@ -71,20 +87,11 @@ def extract_data_from_video(video_path, filehash):
     if not os.path.exists(frames_path):
         os.makedirs(frames_path)
 
-    # Calculate scale
-    cam = cv2.VideoCapture(single_video)
-    fps = cam.get(cv2.CAP_PROP_FPS)
-    total_frames = int(cam.get(cv2.CAP_PROP_FRAME_COUNT))
     # get duration of video to check if we need splitting
-    duration = total_frames / fps
+    duration, audio_codec = probe_media(single_video)
 
     # Scale video down to width of 320 and the corresponding height based on the aspect ratio
-    # get one frame each 2 seconds if video is under 10 minutes
-    # get one frame each 5 seconds if video is over 10 minutes
-    if duration < 600:
-        vf_filter = "fps=1/12 ,scale=320:-1"
-    else:
-        vf_filter = "fps=1/20 ,scale=320:-1"
+    vf_filter = f"fps=1/{get_frame_interval(duration)} ,scale=320:-1"
 
     output_pattern = os.path.join(frames_path, "frame_%04d.jpg")
 
@@ -93,54 +100,135 @@ def extract_data_from_video(video_path, filehash):
         "-v", "quiet",  # less logs
         "-y",  # override file if exists
         "-i", single_video,  # input video
+        "-map", "0:v:0",  # first output: frames of the video stream
         "-vf", vf_filter,  # apply filter
         "-vsync", "0",  # apply filter
         output_pattern  # define ouput pattern
     ]
 
+    # we also need to transcribe the audio in the video, it is extracted in the same pass
+    audio_output = None
+    if audio_codec is not None:
+        audio_path = os.path.join(
+            app.root_path, os.path.join(f"temp/{filehash}/", "audio")
+        )
+
+        if not os.path.exists(audio_path):
+            os.makedirs(audio_path)
+        audio_output = os.path.join(audio_path, "audio.mp3")
+        command += [
+            "-map", "0:a:0",  # second output: the audio stream
+            "-b:a", '192k',  # set bitrate
+            "-acodec", "libmp3lame",  # force mp3
+            audio_output  # define output
+        ]
+
     try:
         subprocess.run(command, check=True)
         print(f"Saved frames: {output_pattern} ")
+        if audio_output:
+            print(f"Saved Audio in {audio_output}")
     except subprocess.CalledProcessError as e:
-        abort(500, description=f"Error FFMPEG (Frame Extraction): {e}")
+        abort(500, description=f"Error FFMPEG (Frame and Audio Extraction): {e}")
 
-    # we also need to transcribe the audio in the video
-    audio_path = os.path.join(
-        app.root_path, os.path.join(f"temp/{filehash}/", "audio")
-    )
+    # return path of frames and audio file
+    return frames_path, audio_output, duration
 
-    if not os.path.exists(audio_path):
-        os.makedirs(audio_path)
-    audio_output = os.path.join(audio_path, "audio.mp3")
-    command = [
-        "ffmpeg",
-        "-v", "quiet",  # less logs
-        "-y",  # override file
-        "-i", f'{single_video}',  # set input file
-        "-b:a", '192k',  # set input file
-        "-acodec", "libmp3lame",  # force mp3
-        audio_output  # define output
-    ]
 
-    try:
-        subprocess.run(command, check=True)
-        print(f"Saved Audio in {audio_output}")
-    except subprocess.CalledProcessError as e:
-        abort(500, description=f"Error FFMPEG (Audio Extraction): {e}")
+def get_frame_interval(duration):
+    """
+    :param duration: duration of the video
+    :return: seconds between two frames extracted from the video
+    """
+    if VIDEO_FRAME_SAMPLING == "adaptive":
+        return VIDEO_ADAPTIVE_SAMPLE_SECONDS
+    return get_fixed_frame_interval(duration)
 
-    # return path of frames and audio file
-    return frames_path, audio_output, duration
+
+def get_fixed_frame_interval(duration):
+    """
+    :param duration: duration of the video
+    :return: seconds between two frames in fixed mode
+    """
+    # get one frame each 12 seconds if video is under 10 minutes
+    # get one frame each 20 seconds if video is over 10 minutes
+    if duration < 600:
+        return 12
+    return 20
 
 
-def process_segments(frames, transcription, duration, socket_id):
+def frame_hash(frame_path):
+    """
+    perceptual difference hash (dHash) of a frame
+    :param frame_path: path to the frame
+    :return: 64 bit hash as int
+    """
+    with Image.open(frame_path) as image:
+        pixels = list(image.convert("L").resize((9, 8)).getdata())
+    hash_value = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            right = pixels[row * 9 + column + 1]
+            hash_value = (hash_value << 1) | (left > right)
+    return hash_value
+
+
+def sample_frames(frames, duration):
+    """
+    Select the frames that are sent to the vision model
+    In adaptive mode a frame is dropped if it looks like the last kept frame, afterwards
+    every minute of the video is limited to VIDEO_FRAMES_PER_MINUTE evenly spread frames
+    and the whole video to the amount of frames fixed mode would send.
+    :param frames: all extracted frames of the video in order
+    :param duration: duration of the video
+    :return: the selected frames and their timestamps in seconds (None in fixed mode)
+    """
+    if VIDEO_FRAME_SAMPLING != "adaptive":
+        return frames, None
+
+    interval = get_frame_interval(duration)
+    frames_by_minute = {}
+    last_hash = None
+    for index, frame in enumerate(frames):
+        current_hash = frame_hash(frame)
+        if last_hash is not None and (current_hash ^ last_hash).bit_count() <= VIDEO_FRAME_SIMILARITY:
+            continue
+        last_hash = current_hash
+        timestamp = index * interval
+        frames_by_minute.setdefault(int(timestamp // 60), []).append((frame, timestamp))
+
+    selected = []
+    for minute_frames in frames_by_minute.values():
+        if len(minute_frames) > VIDEO_FRAMES_PER_MINUTE:
+            step = len(minute_frames) / VIDEO_FRAMES_PER_MINUTE
+            minute_frames = [minute_frames[int(i * step)] for i in range(VIDEO_FRAMES_PER_MINUTE)]
+        selected.extend(minute_frames)
+
+    max_frames = max(1, math.ceil(duration / get_fixed_frame_interval(duration)))
+    if len(selected) > max_frames:
+        step = len(selected) / max_frames
+        selected = [selected[int(i * step)] for i in range(max_frames)]
+
+    print(f"Selected {len(selected)} of {len(frames)} frames")
+    return [frame for frame, _ in selected], [timestamp for _, timestamp in selected]
+
+
+def process_segments(frames, transcription, duration, socket_id, frame_timestamps=None):
     """
     :param frames: all the frames of the video
     :param transcription: transcription of the video
     :param duration: duration of the video
     :param socket_id: socket_id of the socket to send messages
+    :param frame_timestamps: timestamp in seconds of each frame, frames are evenly spread over the video if not given
     :return: dict that contains the video summary
     """
-    seconds = round(duration / len(frames))
+    if frame_timestamps is None:
+        seconds = round(duration / len(frames))
+        # the last entry is the end of the last frame
+        frame_times = [i * seconds for i in range(len(frames) + 1)]
+    else:
+        frame_times = [*frame_timestamps, duration]
     # calculate how many rounds we need to analyze the frames
     # here we are dividing by 49 and rounding that value up
     frame_segments = math.floor(len(frames) / 50)
@@ -162,11 +250,6 @@ def process_segments(frames, transcription, duration, socket_id):
     }
 
     if frame_segments > 0:
-        # prompt_dict will include all frames that we need to analyze
-        prompt_dict = []
-        # iterate over all segments (frame_count/50)
-        video_summary = ""
-
         total_iterations = len(frames)
         max_group_size = 50
 
@@ -177,53 +260,45 @@ def process_segments(frames, transcription, duration, socket_id):
         if remainder > 0:
             groups.append(remainder)
 
-        start = 0
-        step = 0
-        for group in groups:
-            sio.emit('llm_message',
-                     {'message': f'Analyzing Video Chunk {step + 1}/{str(len(groups))}', 'socket_id': socket_id})
-            prompt_dict.clear()
-            if len(data["video_summary"]["segments"]) == 0:
-                prompt_dict.append(transcription)
-                prompt_dict.append({
-                    "type": "text",
-                    "text": f"Here is part {str(step)} of {str(total_iterations)}. What are all frames showing, be as detailed as possible but please combine everything in a normal text"
-                })
-            else:
-                prompt_dict = [
-                    transcription,
-                    {
-                        "type": "text",
-                        "text": f"Here is the summary of the other parts: {video_summary}. Here is part {str(step)} of {str(total_iterations)}. What are all frames showing, be as detailed as possible but please combine everything in a normal text"
-                    }
-                ]
+        group_starts = [sum(groups[:step]) for step in range(len(groups))]
 
-            start_timestamp = convert_timestamp_to_str((start) * seconds)
-            end_timestamp = convert_timestamp_to_str((start + group) * seconds)
-            for i in range(start, start + group):
-                encoding = encode_image(frames[i])
-                base64_image = {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/jpeg;base64,{encoding}",
-                        "detail": "auto"
-                    }
-                }
-                prompt_dict.append(base64_image)
-            sum_part = image_to_openai(prompt_dict)
-            summary = {
-                "start_timestamp": start_timestamp,
-                "end_timestamp": end_timestamp,
-                "content": sum_part,
-            }
-            video_summary = video_summary + f"Video Summary Part {str(step)} of {str(frame_segments)} (Timestamps: {start_timestamp} - {end_timestamp}):\n" + sum_part + "\n\n"
-            data["video_summary"]["segments"].append(summary)
-            start += group
-            step = step + 1
+        if VIDEO_SUMMARY_MODE == "parallel":
+            # every group is summarized on its own, the parts are merged in timestamp order afterwards
+            with concurrent.futures.ThreadPoolExecutor(max_workers=VIDEO_MAX_WORKERS) as executor:
+                futures = [
+                    executor.submit(summarize_frame_group, frames, start, group, frame_times, transcription,
+                                    step, total_iterations)
+                    for step, (start, group) in enumerate(zip(group_starts, groups))
+                ]
+                analyzed = 0
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+                    analyzed += 1
+                    sio.emit('llm_message',
+                             {'message': f'Analyzed Video Chunk {analyzed}/{str(len(groups))}', 'socket_id': socket_id})
+
+            video_summary = ""
+            for step, future in enumerate(futures):
+                summary = future.result()
+                video_summary = video_summary + f"Video Summary Part {str(step)} of {str(frame_segments)} (Timestamps: {summary['start_timestamp']} - {summary['end_timestamp']}):\n" + summary["content"] + "\n\n"
+                data["video_summary"]["segments"].append(summary)
+
+            sio.emit('llm_message', {'message': 'Merging Video Chunks...', 'socket_id': socket_id})
+            data["video_summary"]["summary"] = video_openai(video_summary)
+        else:
+            # every group gets the summary of all previous groups
+            video_summary = ""
+            for step, (start, group) in enumerate(zip(group_starts, groups)):
+                sio.emit('llm_message',
+                         {'message': f'Analyzing Video Chunk {step + 1}/{str(len(groups))}', 'socket_id': socket_id})
+                summary = summarize_frame_group(frames, start, group, frame_times, transcription,
+                                                step, total_iterations, video_summary)
+                video_summary = video_summary + f"Video Summary Part {str(step)} of {str(frame_segments)} (Timestamps: {summary['start_timestamp']} - {summary['end_timestamp']}):\n" + summary["content"] + "\n\n"
+                data["video_summary"]["segments"].append(summary)
     else:
         sio.emit('llm_message', {'message': 'Analyzing Video Chunk...', 'socket_id': socket_id})
         start_timestamp = convert_timestamp_to_str(0)
-        end_timestamp = convert_timestamp_to_str(len(frames) * seconds)
+        end_timestamp = convert_timestamp_to_str(frame_times[len(frames)])
         prompt_dict = [
             transcription,
             {
@@ -252,13 +327,63 @@ def process_segments(frames, transcription, duration, socket_id):
     return data
 
 
-# method to get all frames in a directory
+def summarize_frame_group(frames, start, group, frame_times, transcription, step, total_iterations, video_summary=""):
+    """
+    Summarize one group of up to 50 frames with the vision model
+    :param frames: all the frames of the video
+    :param start: index of the first frame of the group
+    :param group: amount of frames in the group
+    :param frame_times: timestamp of each frame, followed by the end of the last frame
+    :param transcription: transcription prompt of the video
+    :param step: index of the group
+    :param total_iterations: amount of frames
+    :param video_summary: summary of the previous groups, empty if the groups are summarized independently
+    :return: dict that contains the timestamps and the summary of the group
+    """
+    if not video_summary:
+        prompt_dict = [
+            transcription,
+            {
+                "type": "text",
+                "text": f"Here is part {str(step)} of {str(total_iterations)}. What are all frames showing, be as detailed as possible but please combine everything in a normal text"
+            }
+        ]
+    else:
+        prompt_dict = [
+            transcription,
+            {
+                "type": "text",
+                "text": f"Here is the summary of the other parts: {video_summary}. Here is part {str(step)} of {str(total_iterations)}. What are all frames showing, be as detailed as possible but please combine everything in a normal text"
+            }
+        ]
+
+    start_timestamp = convert_timestamp_to_str(frame_times[start])
+    end_timestamp = convert_timestamp_to_str(frame_times[start + group])
+    for i in range(start, start + group):
+        encoding = encode_image(frames[i])
+        base64_image = {
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:image/jpeg;base64,{encoding}",
+                "detail": "auto"
+            }
+        }
+        prompt_dict.append(base64_image)
+    sum_part = image_to_openai(prompt_dict)
+    return {
+        "start_timestamp": start_timestamp,
+        "end_timestamp": end_timestamp,
+        "content": sum_part,
+    }
+
+
+# method to get all frames in a directory, sorted by frame number
 def get_all_frames_in_dir(path):
     f = []
     for (dirpath, dirnames, filenames) in os.walk(path):
         for file in filenames:
             f.append(os.path.join(dirpath, file))
-    return f
+    return sorted(f)
 
 
 # method to get all video segments in a directory
@@ -1,3 +1,4 @@
+import concurrent.futures
 import os
 import subprocess
 from itertools import islice
@@ -5,13 +6,15 @@
 from flask import abort
 
 from app import app, sio
-from audio import split_audio_with_overlap
+from audio import split_audio_with_overlap, probe_media
 from azure import get_whisper
 from glossary import list_to_comma
 from app import temp_folder
 
 split_length_ms = 300000
 split_length_s = split_length_ms / 1000
+# maximum amount of audio chunks that are transcribed at the same time
+WHISPER_MAX_WORKERS = int(os.getenv("WHISPER_MAX_WORKERS", 4))
 
 
 class Segment:
@@ -39,7 +42,7 @@ def transcribe(path, filehash, file_as_dicts, socket_id):
     :param socket_id: to send socket messages to the frontend
     :return: dictionary that contains the transcription
     """
-    if os.path.isfile(path) is True:
+    if path is not None and os.path.isfile(path) is True:
 
         glossary_terms = []
         for dict in file_as_dicts:
@@ -58,8 +61,11 @@ def transcribe(path, filehash, file_as_dicts, socket_id):
             }
         }
 
-        sio.emit('llm_message', {'message': f'Converting Audio to MP3', 'socket_id': socket_id})
-        path = convert_to_mp3(filehash, path)
+        # audio extracted from videos is already mp3 and does not need another transcode
+        _, audio_codec = probe_media(path)
+        if audio_codec != "mp3":
+            sio.emit('llm_message', {'message': f'Converting Audio to MP3', 'socket_id': socket_id})
+            path = convert_to_mp3(filehash, path)
 
         # check file size because only 25Mb/request are allowed for Whisper transcription
         file_size_mb = os.stat(path).st_size / (1024 * 1024)
@@ -68,33 +74,28 @@ def transcribe(path, filehash, file_as_dicts, socket_id):
         if float(file_size_mb) > 24.0:
             # get multiple split segments
             sio.emit('llm_message', {'message': 'Splitting Audio in multiple chunks...', 'socket_id': socket_id})
-            chunks = split_audio_with_overlap(path, segment_length_ms=split_length_ms, overlap_ms=500)
-            for idx, segment in enumerate(chunks):
-                sio.emit('llm_message',
-                         {'message': f'Transcribing Audio Chunk {idx + 1}/{len(chunks)}', 'socket_id': socket_id})
-                dir = os.path.join(app.root_path, os.path.join(f"{temp_folder}/{filehash}/audio"))
-                if not os.path.exists(dir):
-                    os.makedirs(dir)
-                path = os.path.join(app.root_path, os.path.join(f"{temp_folder}/{filehash}/audio", f"audio_{idx}.mp3"))
-                # save to mp3 format in temp folder
-                segment.export(path, format="mp3")
-
-                # Set up AzureChatOpenAI with the required configurations
-                audio_file = open(path, "rb")
-                response = get_whisper(audio_file, whisper_prompt)
-
-                segments = response.segments
-                combined_segments = []
-
-                # to make the array not too large we are merging multiple (n = 4) transcription segments into one
-                n = 4
-                for i in range(0, len(segments), n):
-                    group_segments = list(islice(segments, i, i + n))
-                    combined_segments.append(combine_segments(group_segments))
-                generated_dict = generate_segment_dict(combined_segments, idx)
-
+            # segments are written as mp3 files into the temp folder
+            dir = os.path.join(app.root_path, os.path.join(f"{temp_folder}/{filehash}/audio"))
+            chunk_paths = split_audio_with_overlap(path, dir, segment_length_ms=split_length_ms, overlap_ms=500)
+
+            sio.emit('llm_message',
+                     {'message': f'Transcribing {len(chunk_paths)} Audio Chunks...', 'socket_id': socket_id})
+
+            # transcribe all chunks concurrently, the results are stitched together in chunk order
+            with concurrent.futures.ThreadPoolExecutor(max_workers=WHISPER_MAX_WORKERS) as executor:
+                futures = [executor.submit(transcribe_chunk, chunk_path, idx, whisper_prompt)
+                           for idx, chunk_path in enumerate(chunk_paths)]
+                transcribed = 0
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+                    transcribed += 1
+                    sio.emit('llm_message',
+                             {'message': f'Transcribed Audio Chunk {transcribed}/{len(chunk_paths)}',
+                              'socket_id': socket_id})
+
+            for future in futures:
                 # attach generated dictionary to data dictionary
-                data["transcription"]["segments"].extend(generated_dict)
+                data["transcription"]["segments"].extend(future.result())
             return data
         else:
             sio.emit('llm_message', {'message': 'Transcribing audio...', 'socket_id': socket_id})
@@ -119,6 +120,28 @@ def transcribe(path, filehash, file_as_dicts, socket_id):
         return data
 
 
+def transcribe_chunk(path, idx, whisper_prompt):
+    """
+    Transcribe one chunk of a split audio file
+    :param path: path to the audio chunk
+    :param idx: index of the chunk, used to offset the timestamps
+    :param whisper_prompt: prompt for Whisper
+    :return: list of segment dictionaries
+    """
+    with open(path, "rb") as audio_file:
+        response = get_whisper(audio_file, whisper_prompt)
+
+    segments = response.segments
+    combined_segments = []
+
+    # to make the array not too large we are merging multiple (n = 4) transcription segments into one
+    n = 4
+    for i in range(0, len(segments), n):
+        group_segments = list(islice(segments, i, i + n))
+        combined_segments.append(combine_segments(group_segments))
+    return generate_segment_dict(combined_segments, idx)
+
+
 def combine_segments(group_segments):
     """
     # Method to merge multiple segments into one bigger segments to reduce the size of the transcription array